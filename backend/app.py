@@ -2,14 +2,19 @@
 Flask API Server for Bill/Invoice OCR Extraction
 """
 
+import binascii
+import json
+import multiprocessing
 import os
-import tempfile
-import threading
-from flask import Flask, request, jsonify
+from functools import partial
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
 
-from ocr_service import process_bill_image
+from ocr_boxes import OCRBoxes
+from ocr_service import process_bill_bytes, extract_layout, PIPELINE_PARAMS
+from jobs import JobStore, QueueFull
+from result_cache import ResultCache, cache_key
+from metrics import REGISTRY, Gauge, CACHE_HITS_TOTAL, TIMEOUTS_TOTAL, STAGE_SECONDS
 
 app = Flask(__name__)
 
@@ -20,6 +25,30 @@ CORS(app)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp', 'heic'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+EXTRACT_TIMEOUT = 25  # ⏱️ Render free-tier safe
+STREAM_KEEPALIVE = 15  # seconds between keepalive events on idle streams
+
+jobs = JobStore()
+results = ResultCache()
+
+# Start loading the models now, not on the first request. Skipped in the worker
+# processes themselves, which import this module when it is run as a script.
+if multiprocessing.current_process().name == 'MainProcess':
+    jobs.pool.start()
+
+REGISTRY.register(Gauge(
+    'invoice_ocr_queue_depth', 'Jobs waiting for a free worker', lambda: jobs.pool.stats()[0]
+))
+REGISTRY.register(Gauge(
+    'invoice_ocr_jobs_in_flight', 'Jobs currently running in a worker', lambda: jobs.pool.stats()[1]
+))
+
+
+@app.errorhandler(QueueFull)
+def queue_full(e):
+    response = jsonify({"success": False, "error": "Server busy, please retry later"})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 429
 
 
 def allowed_file(filename):
@@ -35,62 +64,304 @@ def health_check():
     })
 
 
-@app.route('/api/extract', methods=['POST'])
-def extract_invoice():
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """Ready once at least one worker has loaded and warmed up its models"""
+    status = jobs.pool.readiness()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+def read_upload():
+    """
+    Validate the multipart upload and read the image bytes.
+
+    Returns:
+        (data, None) on success, or (None, error_response) if the upload is invalid
+    """
     if 'image' not in request.files:
-        return jsonify({"success": False, "error": "No image uploaded"}), 400
+        return None, (jsonify({"success": False, "error": "No image uploaded"}), 400)
 
     file = request.files['image']
 
     if file.filename == '':
-        return jsonify({"success": False, "error": "Empty filename"}), 400
+        return None, (jsonify({"success": False, "error": "Empty filename"}), 400)
 
     if not allowed_file(file.filename):
-        return jsonify({"success": False, "error": "Unsupported file type"}), 400
+        return None, (jsonify({"success": False, "error": "Unsupported file type"}), 400)
 
-    temp_dir = tempfile.mkdtemp()
-    temp_path = os.path.join(temp_dir, secure_filename(file.filename))
-    file.save(temp_path)
+    # Decoded in memory by the worker; the upload never touches the disk
+    return file.read(), None
 
-    result = {
-        "success": False,
-        "error": "OCR timeout",
-        "header": {},
-        "items": []
-    }
 
-    def run_ocr():
-        nonlocal result
-        result = process_bill_image(temp_path)
+def read_base64_image():
+    """
+    Decode the base64 image of a JSON body: {"image": "<base64 or data URL>"}.
 
-    t = threading.Thread(target=run_ocr)
-    t.start()
-    t.join(timeout=25)  # ⏱️ Render free-tier safe
+    The body is read without caching and every intermediate copy is dropped as
+    soon as the next one exists, so at most two full copies of a large image are
+    alive at any time.
 
+    Returns:
+        (data, None) on success, or (None, error_response) if the payload is invalid
+    """
     try:
-        os.remove(temp_path)
-        os.rmdir(temp_dir)
-    except:
-        pass
+        payload = json.loads(request.get_data(cache=False))
+    except ValueError:
+        return None, (jsonify({"success": False, "error": "Invalid JSON body"}), 400)
+
+    encoded = payload.pop('image', None) if isinstance(payload, dict) else None
+    del payload
+    if not isinstance(encoded, str) or not encoded:
+        return None, (jsonify({"success": False, "error": "No image uploaded"}), 400)
+
+    # Strip a data URL prefix such as "data:image/jpeg;base64,"
+    if encoded.startswith('data:'):
+        comma = encoded.find(',', 0, 256)
+        if comma == -1:
+            return None, (jsonify({"success": False, "error": "Invalid data URL"}), 400)
+        encoded = encoded[comma + 1:]
+
+    try:
+        data = binascii.a2b_base64(encoded)
+    except (binascii.Error, ValueError):
+        return None, (jsonify({"success": False, "error": "Invalid base64 image"}), 400)
+    del encoded
+
+    if not data:
+        return None, (jsonify({"success": False, "error": "No image uploaded"}), 400)
+
+    return data, None
 
-    if t.is_alive():
+
+def read_image():
+    """Read the image from either a base64 JSON body or a multipart upload"""
+    if request.is_json:
+        return read_base64_image()
+    return read_upload()
+
+
+def submit_extraction(data):
+    """
+    Queue extraction of an encoded image, or return a finished job straight
+    away if the same image was already processed with the same parameters.
+    A cached result is laid out again from its OCR boxes, so layout templates
+    learned or edited since it was cached apply to it.
+    """
+    key = cache_key(data, PIPELINE_PARAMS)
+    cached = results.get(key)
+    if cached is not None:
+        CACHE_HITS_TOTAL.inc()
+        if 'boxes' in cached:
+            timings = {}
+            result = extract_layout(OCRBoxes.from_dict(cached['boxes']), timings=timings, learn_template=False)
+            for stage, seconds in timings.items():
+                STAGE_SECONDS.observe(seconds, stage)
+            cached = {**result, 'boxes': cached['boxes']}
+        return jobs.add_finished(cached)
+
+    def remember(result):
+        if result.get("success"):
+            results.put(key, result)
+
+    # The OCR boxes are kept with the job (and cached) for /api/relayout
+    return jobs.submit(partial(process_bill_bytes, keep_boxes=True), data, on_result=remember)
+
+
+def job_response(job):
+    """Wait for an extraction job and build the synchronous API response"""
+    if not jobs.wait(job, timeout=EXTRACT_TIMEOUT):
+        # Nobody will collect this result, so free the worker for the next request.
+        # Clients that can wait longer should use /api/jobs instead.
+        jobs.cancel(job)
+        TIMEOUTS_TOTAL.inc()
         return jsonify({
             "success": False,
             "error": "OCR processing timed out"
         }), 504
 
+    result = job.result
+    if result is None:
+        return jsonify({
+            "success": False,
+            "error": job.error or "OCR processing failed",
+            "header": {},
+            "items": []
+        }), 500
+
     if result.get("success"):
-        return jsonify(result), 200
+        return jsonify({**result, "jobId": job.id}), 200
 
     return jsonify(result), 422
 
 
+@app.route('/api/extract', methods=['POST'])
+def extract_invoice():
+    data, error_response = read_upload()
+    if error_response:
+        return error_response
+
+    job = submit_extraction(data)
+    return job_response(job)
+
+
 @app.route('/api/extract-base64', methods=['POST'])
 def extract_base64():
-    return jsonify({
-        "success": False,
-        "error": "Not implemented"
-    }), 501
+    data, error_response = read_base64_image()
+    if error_response:
+        return error_response
+
+    job = submit_extraction(data)
+    return job_response(job)
+
+
+def format_event(event, data, sse):
+    if sse:
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return json.dumps({"event": event, "data": data}) + "\n"
+
+
+def stream_job(job, cancel_on_close):
+    """
+    Stream a job's events as they happen: 'stage' as each stage starts,
+    'header' as soon as the header is extracted, one 'item' per table row,
+    then a final 'result' or 'error'.
+
+    Sent as Server-Sent Events if the client accepts text/event-stream or
+    passes ?format=sse, and as newline-delimited JSON otherwise.
+    """
+    sse = (request.args.get('format') == 'sse'
+           or 'text/event-stream' in request.headers.get('Accept', ''))
+
+    def generate():
+        index = 0
+        try:
+            while True:
+                events = job.wait_events(index, timeout=STREAM_KEEPALIVE)
+                index += len(events)
+                for event, data in events:
+                    yield format_event(event, data, sse)
+                if job.done.is_set() and index >= len(job.events):
+                    break
+                if not events:
+                    yield ": keepalive\n\n" if sse else format_event("ping", {}, sse)
+        finally:
+            # The client went away; nobody else will collect this result
+            if cancel_on_close and not job.done.is_set():
+                jobs.cancel(job)
+
+    mimetype = 'text/event-stream' if sse else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+@app.route('/api/extract-stream', methods=['POST'])
+def extract_stream():
+    data, error_response = read_image()
+    if error_response:
+        return error_response
+
+    job = submit_extraction(data)
+    return stream_job(job, cancel_on_close=True)
+
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    data, error_response = read_image()
+    if error_response:
+        return error_response
+
+    job = submit_extraction(data)
+    return jsonify({"success": True, **job.to_dict()}), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown or expired job"}), 404
+
+    return jsonify({"success": True, **job.to_dict()}), 200
+
+
+@app.route('/api/jobs/<job_id>/stream', methods=['GET'])
+def stream_existing_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown or expired job"}), 404
+
+    return stream_job(job, cancel_on_close=False)
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown or expired job"}), 404
+
+    jobs.cancel(job)
+    return jsonify({"success": True, **job.to_dict()}), 202
+
+
+def read_layout_params(payload):
+    """
+    Read the optional layout parameters of a re-layout request.
+
+    Returns:
+        (kwargs for extract_layout(), None), or (None, error message)
+    """
+    params = {}
+
+    boundaries = payload.get('columnBoundaries')
+    if boundaries is not None:
+        if (not isinstance(boundaries, list) or len(boundaries) != 4
+                or not all(isinstance(b, (int, float)) and not isinstance(b, bool) for b in boundaries)
+                or not all(a < b for a, b in zip([0] + boundaries, boundaries + [1]))):
+            return None, "columnBoundaries must be 4 increasing page-width fractions between 0 and 1"
+        params['column_boundaries'] = boundaries
+
+    factor = payload.get('rowHeightFactor')
+    if factor is not None:
+        if not isinstance(factor, (int, float)) or isinstance(factor, bool) or not 0 < factor <= 5:
+            return None, "rowHeightFactor must be a number of median box heights, up to 5"
+        params['row_height_factor'] = factor
+
+    return params, None
+
+
+@app.route('/api/relayout', methods=['POST'])
+def relayout():
+    """
+    Lay out the OCR boxes of a finished job again, optionally with new column
+    boundaries or row threshold, without running OCR again. Body:
+    {"jobId": "...", "columnBoundaries": [...], "rowHeightFactor": 0.5}
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({"success": False, "error": "Invalid JSON body"}), 400
+
+    job_id = payload.get('jobId')
+    job = jobs.get(job_id) if isinstance(job_id, str) else None
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown or expired job"}), 404
+    if job.boxes is None:
+        return jsonify({"success": False, "error": "Job has no OCR result to lay out"}), 409
+
+    params, error = read_layout_params(payload)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+
+    timings = {}
+    result = extract_layout(OCRBoxes.from_dict(job.boxes), timings=timings, learn_template=False, **params)
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage)
+    return jsonify({**result, "jobId": job.id}), 200
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+"""
+Layout Benchmark
+Times the layout stages (header, table rows, columns) on recorded OCR
+fixtures, without running any OCR model. Record fixtures first with
+record_fixtures.py, or use --synthetic for a generated bill of any size.
+Row grouping is also compared with the original fixed-threshold grouping
+of box dicts.
+"""
+
+import argparse
+import glob
+import os
+import time
+
+import numpy as np
+
+from ocr_boxes import OCRBoxes
+from ocr_engines import OCR_FIXTURE_DIR, load_fixture
+from ocr_service import extract_layout, group_into_rows, REFERENCE_WIDTH
+
+
+# Column centers of the synthetic bill, in reference bill pixels
+SYNTHETIC_COLUMNS = (60, 300, 580, 750, 900)
+SYNTHETIC_PITCH = 40  # pixels between rows
+
+
+def load_boxes(path):
+    """Load a fixture as extract_ocr_data() would have returned it"""
+    boxes, width, height = load_fixture(path)
+    return boxes.normalize(width, height).sorted('y_center', 'x_center')
+
+
+def synthetic_boxes(count, skew=0.0, seed=0):
+    """
+    Generate a bill with a table header and rows of five boxes, about
+    `count` boxes in all, at the reference bill's width.
+
+    Args:
+        skew: Vertical drift of each row across the page, in pixels per pixel
+    """
+    rng = np.random.default_rng(seed)
+    rows = max(1, count // len(SYNTHETIC_COLUMNS))
+    width, height = REFERENCE_WIDTH, 400 + rows * SYNTHETIC_PITCH
+
+    texts, xs, ys = [], [], []
+    for x, text in zip(SYNTHETIC_COLUMNS, ('MRP', 'Particulars', 'Qty', 'Rate', 'Total')):
+        texts.append(text)
+        xs.append(x)
+        ys.append(320)
+    for row in range(rows):
+        for x, text in zip(SYNTHETIC_COLUMNS, ('10', f'Item {row}', '2', '150', '300')):
+            texts.append(text)
+            xs.append(x)
+            ys.append(360 + row * SYNTHETIC_PITCH + skew * x)
+
+    xs = np.array(xs, dtype=np.float64) + rng.normal(0, 3, len(xs))
+    ys = np.array(ys, dtype=np.float64) + rng.normal(0, 2, len(ys))
+    half_widths = rng.uniform(20, 60, len(xs))
+    half_heights = rng.uniform(8, 12, len(xs))
+    boxes = OCRBoxes.from_bounds(
+        texts, np.full(len(texts), 0.9),
+        xs - half_widths, xs + half_widths, ys - half_heights, ys + half_heights
+    )
+    return boxes.normalize(width, height).sorted('y_center', 'x_center')
+
+
+def baseline_group_into_rows(data, y_threshold=25):
+    """
+    Row grouping before adaptive clustering, kept for comparison: box dicts
+    within y_threshold pixels of the first box of a row join it.
+    """
+    if not data:
+        return []
+
+    data_sorted = sorted(data, key=lambda x: x['y_center'])
+    rows = []
+    current_row = [data_sorted[0]]
+    last_y = data_sorted[0]['y_center']
+
+    for item in data_sorted[1:]:
+        if abs(item['y_center'] - last_y) <= y_threshold:
+            current_row.append(item)
+        else:
+            if current_row:
+                current_row.sort(key=lambda x: x['x_center'])
+                rows.append(current_row)
+            current_row = [item]
+            last_y = item['y_center']
+
+    if current_row:
+        current_row.sort(key=lambda x: x['x_center'])
+        rows.append(current_row)
+
+    return rows
+
+
+def bench_grouping(boxes, repeat):
+    """
+    Group the same boxes into rows `repeat` times, each way from the input
+    it was written for: OCRBoxes, and box dicts for the baseline.
+
+    Returns:
+        (milliseconds per run, baseline milliseconds per run)
+    """
+    records = boxes.records()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        group_into_rows(boxes)
+    current = (time.perf_counter() - start) * 1000 / repeat
+    start = time.perf_counter()
+    for _ in range(repeat):
+        baseline_group_into_rows(records)
+    return current, (time.perf_counter() - start) * 1000 / repeat
+
+
+def bench(boxes, repeat):
+    """
+    Lay out the same boxes `repeat` times.
+
+    Returns:
+        (milliseconds per run, {stage: milliseconds per run})
+    """
+    timings = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        extract_layout(boxes, timings=timings, learn_template=False)
+    total = (time.perf_counter() - start) * 1000 / repeat
+    return total, {name: seconds * 1000 / repeat for name, seconds in timings.items()}
+
+
+def fixture_paths(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, '*.json')))
+        else:
+            yield path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the layout stages on recorded OCR fixtures")
+    parser.add_argument('fixtures', nargs='*', default=[OCR_FIXTURE_DIR],
+                        help="fixture files or directories (default: %(default)s)")
+    parser.add_argument('--repeat', type=int, default=100, help="runs per fixture (default: %(default)s)")
+    parser.add_argument('--synthetic', type=int, metavar='BOXES',
+                        help="benchmark a generated bill with about this many boxes instead")
+    parser.add_argument('--skew', type=float, default=0.0,
+                        help="row drift of the generated bill, in pixels per pixel (default: %(default)s)")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        boxes = synthetic_boxes(args.synthetic, args.skew)
+        total, stages = bench(boxes, args.repeat)
+        detail = '  '.join(f"{name}={ms:.3f}" for name, ms in sorted(stages.items()))
+        print(f"synthetic: {len(boxes)} boxes, {total:.3f} ms  ({detail})")
+        grouping, baseline = bench_grouping(boxes, args.repeat)
+        print(f"  row grouping: {grouping:.3f} ms, baseline {baseline:.3f} ms")
+        parser.exit()
+
+    paths = list(fixture_paths(args.fixtures))
+    if not paths:
+        parser.exit(1, "No fixtures found; record some with record_fixtures.py\n")
+
+    for path in paths:
+        boxes = load_boxes(path)
+        total, stages = bench(boxes, args.repeat)
+        detail = '  '.join(f"{name}={ms:.3f}" for name, ms in sorted(stages.items()))
+        print(f"{os.path.basename(path)}: {len(boxes)} boxes, {total:.3f} ms  ({detail})")
+        grouping, baseline = bench_grouping(boxes, args.repeat)
+        print(f"  row grouping: {grouping:.3f} ms, baseline {baseline:.3f} ms")
@@ -0,0 +1,244 @@
+"""
+Job Store Module
+Runs bill extraction jobs in the background and keeps their results until a TTL expires.
+"""
+
+import math
+import os
+import threading
+import time
+import uuid
+
+from metrics import STAGE_SECONDS, JOB_SECONDS, JOBS_TOTAL, TIMEOUTS_TOTAL, REJECTED_TOTAL
+from worker_pool import WorkerPool
+
+
+# Configuration
+JOB_RESULT_TTL = int(os.environ.get("JOB_RESULT_TTL", 600))  # seconds
+JOB_TIMEOUT = int(os.environ.get("JOB_TIMEOUT", 300))  # seconds a job may run before it is cancelled
+JOB_QUEUE_DEPTH = int(os.environ.get("JOB_QUEUE_DEPTH", 4))  # jobs allowed to wait for a free worker
+JOB_LATENCY_ESTIMATE = 10.0  # seconds per job until real jobs have been measured
+
+
+class QueueFull(Exception):
+    """Raised when a job is rejected because the waiting queue is full"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Server busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class Job:
+    """A single extraction job and its current state"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.result = None
+        self.boxes = None  # OCR boxes of the result, for re-layout
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.timings = {}
+        self.partial = {'header': None, 'items': []}  # results available before the job ends
+        self.events = []  # (event, data) in order, replayed to streaming clients
+        self.done = threading.Event()
+        self._changed = threading.Condition()
+
+    def set_stage(self, stage):
+        self.stage = stage
+        self.add_event('stage', {'stage': stage})
+
+    def set_result(self, result):
+        """Store a pipeline result, keeping its OCR boxes apart from what clients see"""
+        if 'boxes' in result:
+            result = dict(result)
+            self.boxes = result.pop('boxes')
+        self.result = result
+
+    def add_partial(self, event, data):
+        """Record a partial result ('header' or 'item') reported by the pipeline"""
+        if event == 'header':
+            self.partial['header'] = data
+        elif event == 'item':
+            self.partial['items'].append(data)
+        self.add_event(event, data)
+
+    def add_event(self, event, data, final=False):
+        """
+        Record an event and wake the streams waiting for one. The final
+        event marks the job done under the same lock, so a woken stream
+        never sees it without also seeing that the job has finished.
+        """
+        with self._changed:
+            self.events.append((event, data))
+            if final:
+                self.done.set()
+            self._changed.notify_all()
+
+    def wait_events(self, start, timeout=None):
+        """
+        Return the events from index `start` on, waiting up to `timeout`
+        seconds for new ones if there are none yet and the job is still running.
+        """
+        with self._changed:
+            if len(self.events) <= start and not self.done.is_set():
+                self._changed.wait(timeout)
+            return self.events[start:]
+
+    def to_dict(self):
+        data = {
+            'jobId': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'createdAt': self.created_at,
+            'startedAt': self.started_at,
+            'finishedAt': self.finished_at
+        }
+        if self.error:
+            data['error'] = self.error
+        if self.result is not None:
+            data['result'] = self.result
+        elif self.partial['header'] is not None:
+            data['partial'] = self.partial
+        return data
+
+
+class JobStore:
+    """
+    Thread-safe registry of jobs executed by a pool of OCR worker processes.
+
+    Finished jobs are kept for `ttl` seconds so clients can poll for the
+    result without uploading the image again. Jobs waiting for a worker, or
+    running, for longer than `timeout` seconds are cancelled.
+
+    At most one job per worker runs at a time and at most `queue_depth` more
+    may wait. Beyond that submit() raises QueueFull, so a burst is answered
+    with "retry later" instead of every job timing out in the queue.
+    """
+
+    def __init__(self, pool=None, ttl=JOB_RESULT_TTL, timeout=JOB_TIMEOUT,
+                 queue_depth=JOB_QUEUE_DEPTH):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.queue_depth = queue_depth
+        self._latency = JOB_LATENCY_ESTIMATE  # moving average of job run time
+        self.pool = pool or WorkerPool()
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, on_result=None):
+        """
+        Queue `func(*args, progress=...)` and return its Job immediately.
+        `func` runs in a worker process, so it and its arguments must be picklable.
+
+        `on_result` is called with the result if the job completes,
+        including its OCR boxes if `func` returned them.
+
+        Raises:
+            QueueFull: if the job cannot be admitted now
+        """
+        self._purge_expired()
+        job = Job()
+        with self._lock:
+            self._jobs[job.id] = job
+        accepted = self.pool.submit(
+            job.id, func, args,
+            lambda kind, payload: self._on_event(job, kind, payload, on_result),
+            timeout=self.timeout, max_pending=self.queue_depth
+        )
+        if not accepted:
+            with self._lock:
+                del self._jobs[job.id]
+            REJECTED_TOTAL.inc()
+            raise QueueFull(self.retry_after())
+        return job
+
+    def retry_after(self):
+        """Seconds until a rejected client can expect a free queue slot"""
+        waiting, _ = self.pool.stats()
+        return max(1, math.ceil(self._latency * (waiting + 1) / self.pool.size))
+
+    def cancel(self, job):
+        """
+        Cancel a queued or running job. Its worker stops at the next stage
+        boundary, or is killed if it does not.
+        """
+        if not job.done.is_set():
+            self.pool.cancel(job.id)
+
+    def add_finished(self, result):
+        """Register a job whose result is already known (e.g. a cache hit)"""
+        self._purge_expired()
+        job = Job()
+        job.set_result(result)
+        job.status = job.stage = 'done'
+        job.started_at = job.finished_at = job.created_at
+        job.add_event('result', job.result, final=True)
+        with self._lock:
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        """Return the job with this id, or None if unknown or expired"""
+        self._purge_expired()
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job, timeout=None):
+        """Wait for a job to finish. Returns True if it finished in time."""
+        return job.done.wait(timeout)
+
+    def _on_event(self, job, kind, payload, on_result):
+        """Apply a worker pool event to the job"""
+        if kind == 'start':
+            job.status = 'running'
+            job.started_at = time.time()
+            job.set_stage('started')
+        elif kind == 'stage':
+            job.set_stage(payload)
+        elif kind == 'partial':
+            job.add_partial(*payload)
+        elif kind == 'timings':
+            job.timings = payload
+            for stage, seconds in payload.items():
+                STAGE_SECONDS.observe(seconds, stage)
+        elif kind in ('done', 'error', 'cancelled'):
+            job.finished_at = time.time()
+            if kind == 'done':
+                job.set_result(payload)
+                job.status = 'done'
+                runtime = job.finished_at - job.started_at
+                self._latency = 0.8 * self._latency + 0.2 * runtime
+                JOB_SECONDS.observe(runtime)
+            elif kind == 'cancelled':
+                job.error = 'Job timed out' if payload == 'timeout' else 'Job cancelled'
+                job.status = 'cancelled'
+                if payload == 'timeout':
+                    TIMEOUTS_TOTAL.inc()
+            else:
+                job.error = payload
+                job.status = 'failed'
+            job.stage = job.status
+            JOBS_TOTAL.inc(job.status)
+            if job.result is not None and on_result is not None:
+                try:
+                    on_result(payload)
+                except Exception:
+                    pass
+            if job.result is not None:
+                job.add_event('result', job.result, final=True)
+            else:
+                job.add_event('error', {'status': job.status, 'error': job.error}, final=True)
+
+    def _purge_expired(self):
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished_at is not None and job.finished_at < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
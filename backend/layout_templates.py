@@ -0,0 +1,321 @@
+"""
+Layout Templates Module
+Per-vendor bill layouts: the column geometry of each bill format, learned
+from the table header row once and reused for later bills of that format.
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+
+# Configuration
+LAYOUT_TEMPLATE_DIR = os.environ.get("LAYOUT_TEMPLATE_DIR", "")  # templates to load and save; unset disables
+LAYOUT_TEMPLATE_LEARN = os.environ.get("LAYOUT_TEMPLATE_LEARN", "0") == "1"  # save templates for new formats
+MAX_LEARNED_TEMPLATES = 200  # no more are learned once the registry holds this many
+
+# Table columns in the order they are output, with the header labels that
+# name them on different bill formats
+COLUMN_LABELS = {
+    'mrp': ('mrp',),
+    'particulars': ('particulars', 'description', 'item'),
+    'qty': ('qty', 'quantity'),
+    'rate': ('rate', 'price'),
+    'total': ('total', 'amount')
+}
+
+# A row naming this many columns is the table header; templates are only
+# learned from header rows naming at least MIN_TEMPLATE_LABELS
+MIN_HEADER_LABELS = 2
+MIN_TEMPLATE_LABELS = 3
+
+# Two bills have the same format if their column labels are spaced alike:
+# each label's position relative to the first and last label may differ by
+# this fraction of their distance. Spacing rather than page position keeps
+# photos cropped or zoomed slightly differently on one template.
+TEMPLATE_TOLERANCE = 0.05
+
+# Relative label positions are rounded to this many decimals in fingerprints
+FINGERPRINT_PRECISION = 2
+
+# The template directory is checked for files from other workers at most
+# this often, in seconds
+RELOAD_INTERVAL = 10
+
+_LABEL_PATTERN = re.compile(
+    '|'.join(re.escape(label) for labels in COLUMN_LABELS.values() for label in labels)
+)
+_FIELD_OF_LABEL = {label: field for field, labels in COLUMN_LABELS.items() for label in labels}
+
+
+def find_header_row(ocr_data, min_labels=MIN_HEADER_LABELS):
+    """
+    Find the table header row: the first row of boxes, level with each
+    other, that names at least min_labels columns.
+
+    Args:
+        ocr_data: OCRBoxes with normalized coordinates, sorted top to bottom
+
+    Returns:
+        (fields, indices) for the labels left to right, or None if fewer
+        than MIN_HEADER_LABELS columns are named
+    """
+    texts = [text.lower() for text in ocr_data.text.tolist()]
+    checked = set()
+    for i, text in enumerate(texts):
+        if i in checked or not _LABEL_PATTERN.search(text):
+            continue
+
+        center = ocr_data.ny_center[i]
+        reach = ocr_data.ny_max[i] - ocr_data.ny_min[i]
+        level = np.flatnonzero(np.abs(ocr_data.ny_center - center) <= reach)
+        checked.update(level.tolist())
+
+        fields, indices = [], []
+        for j in level[np.argsort(ocr_data.nx_center[level], kind='stable')].tolist():
+            match = _LABEL_PATTERN.search(texts[j])
+            if match is None:
+                continue
+            field = _FIELD_OF_LABEL[match.group()]
+            if field not in fields:
+                fields.append(field)
+                indices.append(j)
+
+        if len(fields) >= min_labels:
+            return fields, indices
+    return None
+
+
+def relative_positions(centers):
+    """Label centers as fractions of the distance from the first to the last"""
+    span = centers[-1] - centers[0]
+    if span <= 0:
+        return [0.0] * len(centers)
+    return [(center - centers[0]) / span for center in centers]
+
+
+def fingerprint(fields, centers):
+    """Stable id of a column layout: its labels and their rounded relative positions"""
+    layout = '|'.join(
+        f"{field}@{position:.{FINGERPRINT_PRECISION}f}"
+        for field, position in zip(fields, relative_positions(centers))
+    )
+    return hashlib.sha1(layout.encode('utf-8')).hexdigest()[:12]
+
+
+class LayoutTemplate:
+    """
+    Column geometry of one bill format.
+
+    Boxes left of boundaries[0] belong to fields[0], boxes between
+    boundaries[0] and boundaries[1] to fields[1], and so on; all positions
+    are fractions of the page width. A template is recognized by the
+    spacing of its column labels (centers) or, if it lists keywords, by
+    any of them appearing in the page header. name_exclude lists words of
+    the vendor's own letterhead that are never the customer name.
+    """
+
+    def __init__(self, fields, boundaries, centers=None, keywords=(), name_exclude=(),
+                 vendor=None, id=None):
+        self.fields = list(fields)
+        self.boundaries = [float(b) for b in boundaries]
+        self.centers = [float(c) for c in centers] if centers else None
+        self.keywords = tuple(keyword.lower() for keyword in keywords)
+        self.name_exclude = tuple(word.lower() for word in name_exclude)
+        self.id = id or fingerprint(self.fields, self.centers or self.boundaries)
+        self.vendor = vendor or self.id
+        if len(self.boundaries) != len(self.fields) - 1:
+            raise ValueError(f"Template {self.id}: {len(self.fields)} columns need "
+                             f"{len(self.fields) - 1} boundaries")
+
+    @classmethod
+    def learn(cls, fields, ocr_data, indices):
+        """
+        Infer a template from a table header row: each column boundary is
+        halfway across the gap between two neighbouring labels.
+        """
+        x_min = ocr_data.nx_min[indices]
+        x_max = ocr_data.nx_max[indices]
+        boundaries = (x_max[:-1] + x_min[1:]) / 2
+        return cls(fields, boundaries.tolist(), centers=ocr_data.nx_center[indices].tolist())
+
+    def matches_layout(self, fields, centers):
+        if self.centers is None or fields != self.fields:
+            return False
+        return all(
+            abs(a - b) <= TEMPLATE_TOLERANCE
+            for a, b in zip(relative_positions(centers), relative_positions(self.centers))
+        )
+
+    def fitted(self, centers):
+        """
+        This template with its boundaries moved and scaled the way a bill's
+        label centers are moved and scaled from the template's.
+        """
+        if self.centers is None or len(centers) < 2 or self.centers[-1] == self.centers[0]:
+            return self
+        scale = (centers[-1] - centers[0]) / (self.centers[-1] - self.centers[0])
+        boundaries = [centers[0] + (b - self.centers[0]) * scale for b in self.boundaries]
+        return LayoutTemplate(
+            self.fields, boundaries, centers=centers, keywords=self.keywords,
+            name_exclude=self.name_exclude, vendor=self.vendor, id=self.id
+        )
+
+    def matches_header(self, header_text):
+        return any(keyword in header_text for keyword in self.keywords)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'vendor': self.vendor,
+            'fields': self.fields,
+            'boundaries': [round(b, 4) for b in self.boundaries],
+            'centers': [round(c, 4) for c in self.centers] if self.centers else None,
+            'keywords': list(self.keywords),
+            'name_exclude': list(self.name_exclude)
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['fields'], data['boundaries'], centers=data.get('centers'),
+            keywords=data.get('keywords', ()), name_exclude=data.get('name_exclude', ()),
+            vendor=data.get('vendor'), id=data.get('id')
+        )
+
+
+class TemplateRegistry:
+    """
+    Layout templates by id, loaded from a directory of JSON files, which
+    can be written or edited by hand to onboard a format. With learning on,
+    a bill whose table header matches no template teaches a new one, saved
+    there for every later bill (and worker) to reuse, up to
+    MAX_LEARNED_TEMPLATES.
+    """
+
+    def __init__(self, directory=LAYOUT_TEMPLATE_DIR, learn=LAYOUT_TEMPLATE_LEARN):
+        self.directory = directory or None
+        self.learn = learn
+        self._templates = {}
+        self._loaded = set()  # file names already read
+        self._checked_at = 0.0  # last time the directory was listed
+        self._lock = threading.Lock()
+        self.reload()
+
+    def __len__(self):
+        return len(self._templates)
+
+    def reload(self):
+        """Read template files not seen yet, e.g. learned by another worker"""
+        if not self.directory:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            return
+        for name in names:
+            if not name.endswith('.json') or name in self._loaded:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+                    template = LayoutTemplate.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            with self._lock:
+                self._loaded.add(name)
+                self._templates[template.id] = template
+
+    def add(self, template, save=True):
+        with self._lock:
+            self._templates[template.id] = template
+        if save:
+            self._save(template)
+
+    def match(self, ocr_data, header_row, header_text='', learn=True):
+        """
+        Find the template of a bill, learning it from the table header row
+        if the format is new and learning is on.
+
+        Args:
+            ocr_data: OCRBoxes with normalized coordinates, sorted top to bottom
+            header_row: find_header_row() of ocr_data
+            header_text: Lowercased text of the page header, for keyword templates
+            learn: False to never learn from this bill, e.g. in a benchmark
+
+        Returns:
+            LayoutTemplate fitted to the bill, or None to fall back to the
+            generic layout rules
+        """
+        if header_row is not None and len(header_row[0]) < MIN_TEMPLATE_LABELS:
+            header_row = None
+        fields, indices = header_row if header_row is not None else (None, None)
+        centers = ocr_data.nx_center[indices].tolist() if header_row is not None else None
+
+        template = self._find(fields, centers, header_text)
+        if template is None and self.directory and time.monotonic() - self._checked_at > RELOAD_INTERVAL:
+            self.reload()
+            template = self._find(fields, centers, header_text)
+        if template is not None:
+            return template.fitted(centers) if centers is not None else template
+        if header_row is None or not (self.learn and learn) or len(self) >= MAX_LEARNED_TEMPLATES:
+            return None
+
+        template = LayoutTemplate.learn(fields, ocr_data, indices)
+        self.add(template)
+        return template
+
+    def _find(self, fields, centers, header_text):
+        with self._lock:
+            templates = list(self._templates.values())
+            # Cheapest first: a bill laid out exactly like one seen before
+            exact = self._templates.get(fingerprint(fields, centers)) if fields else None
+        if header_text:
+            for template in templates:
+                if template.matches_header(header_text):
+                    return template
+        if fields is None:
+            return None
+        if exact is not None and exact.fields == fields:
+            return exact
+        for template in templates:
+            if template.matches_layout(fields, centers):
+                return template
+        return None
+
+    def _save(self, template):
+        if not self.directory:
+            return
+        name = template.id + '.json'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename so other workers never read a partial file
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(template.to_dict(), f, indent=2)
+            os.replace(temp_path, os.path.join(self.directory, name))
+        except OSError:
+            return
+        with self._lock:
+            self._loaded.add(name)
+
+
+# Created once per process for reuse
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Get or create the layout template registry (singleton pattern)"""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = TemplateRegistry()
+    return _registry
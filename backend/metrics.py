@@ -0,0 +1,135 @@
+"""
+Metrics Module
+In-process counters, gauges and latency summaries rendered in the Prometheus text format.
+"""
+
+import threading
+from collections import deque
+
+
+QUANTILES = (0.5, 0.95, 0.99)
+SUMMARY_WINDOW = 1024  # most recent observations used for quantiles
+
+
+def _labels(label, value, **extra):
+    pairs = []
+    if label is not None and value is not None:
+        pairs.append((label, value))
+    pairs.extend(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Summary:
+    """
+    Count, sum and p50/p95/p99 of observed values, optionally split by one label.
+    Quantiles are computed over the last `window` observations per label value.
+    """
+
+    def __init__(self, name, help_text, label=None, window=SUMMARY_WINDOW):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.window = window
+        self._series = {}  # label value -> [count, sum, recent values]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0, 0.0, deque(maxlen=self.window)]
+            series[0] += 1
+            series[1] += value
+            series[2].append(value)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} summary']
+        with self._lock:
+            snapshot = [(k, c, s, sorted(v)) for k, (c, s, v) in sorted(self._series.items(), key=lambda i: str(i[0]))]
+        for label_value, count, total, values in snapshot:
+            for q in QUANTILES:
+                index = min(len(values) - 1, int(q * len(values)))
+                lines.append(f'{self.name}{_labels(self.label, label_value, quantile=q)} {values[index]:.6f}')
+            lines.append(f'{self.name}_sum{_labels(self.label, label_value)} {total:.6f}')
+            lines.append(f'{self.name}_count{_labels(self.label, label_value)} {count}')
+        return lines
+
+
+class Counter:
+    """Monotonic counter, optionally split by one label"""
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value=None, amount=1):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda i: str(i[0]))
+        if not values and self.label is None:
+            values = [(None, 0)]
+        for label_value, value in values:
+            lines.append(f'{self.name}{_labels(self.label, label_value)} {value}')
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, func):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def render(self):
+        return [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} gauge',
+            f'{self.name} {self.func()}'
+        ]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Summary(
+    'invoice_ocr_stage_seconds', 'Time spent in each extraction pipeline stage', label='stage'
+))
+JOB_SECONDS = REGISTRY.register(Summary(
+    'invoice_ocr_job_seconds', 'Run time of completed extraction jobs'
+))
+JOBS_TOTAL = REGISTRY.register(Counter(
+    'invoice_ocr_jobs_total', 'Finished extraction jobs by outcome', label='status'
+))
+TIMEOUTS_TOTAL = REGISTRY.register(Counter(
+    'invoice_ocr_timeouts_total', 'Extraction requests or jobs that timed out'
+))
+REJECTED_TOTAL = REGISTRY.register(Counter(
+    'invoice_ocr_rejected_total', 'Uploads rejected because the job queue was full'
+))
+CACHE_HITS_TOTAL = REGISTRY.register(Counter(
+    'invoice_ocr_cache_hits_total', 'Uploads answered from the result cache'
+))
@@ -0,0 +1,176 @@
+"""
+OCR Boxes Module
+Columnar storage of OCR text boxes: one NumPy array per coordinate.
+"""
+
+import numpy as np
+
+
+# Pixel coordinates, plus the recognition confidence
+COLUMNS = ('x_min', 'x_max', 'y_min', 'y_max', 'x_center', 'y_center', 'width', 'height', 'confidence')
+
+# Coordinates as fractions of the page size, added by normalize()
+NORMALIZED_COLUMNS = ('nx_min', 'nx_max', 'nx_center', 'ny_min', 'ny_max', 'ny_center')
+
+# Decimal places of pixel coordinates, and of page fractions, kept by to_dict()
+DICT_PRECISION = 1
+NORMALIZED_PRECISION = 6
+
+
+class OCRBoxes:
+    """
+    Text boxes found on a page, held as one float array per column plus an
+    array of texts, so zone filters and sorts are array operations instead
+    of loops over per-box dicts.
+
+    Columns are read as attributes (boxes.x_min, boxes.ny_center, ...) and
+    texts as boxes.text. Indexing with an index array, slice or boolean mask
+    returns a new OCRBoxes; records() gives the list-of-dicts form.
+    """
+
+    def __init__(self, text, columns):
+        self.text = np.empty(len(text), dtype=object)
+        self.text[:] = list(text)
+        self.columns = {
+            name: np.asarray(values, dtype=np.float64)
+            for name, values in columns.items()
+        }
+
+    @classmethod
+    def from_bounds(cls, text, confidence, x_min, x_max, y_min, y_max):
+        x_min, x_max = np.asarray(x_min, dtype=np.float64), np.asarray(x_max, dtype=np.float64)
+        y_min, y_max = np.asarray(y_min, dtype=np.float64), np.asarray(y_max, dtype=np.float64)
+        return cls(text, {
+            'x_min': x_min,
+            'x_max': x_max,
+            'y_min': y_min,
+            'y_max': y_max,
+            'x_center': (x_min + x_max) / 2,
+            'y_center': (y_min + y_max) / 2,
+            'width': x_max - x_min,
+            'height': y_max - y_min,
+            'confidence': confidence
+        })
+
+    @classmethod
+    def from_polys(cls, text, confidence, polys):
+        """
+        Build boxes from detector polygons, reducing all of them to bounding
+        boxes at once.
+
+        Args:
+            text: Recognized text per box
+            confidence: Recognition confidence per box
+            polys: One polygon per box, as a list of (x, y) points
+        """
+        if len(text) == 0:
+            return cls.empty()
+        try:
+            points = np.asarray(polys, dtype=np.float64)
+            mins, maxs = points.min(axis=1), points.max(axis=1)
+        except ValueError:
+            # Polygons with different numbers of points
+            mins = np.array([np.min(poly, axis=0) for poly in polys], dtype=np.float64)
+            maxs = np.array([np.max(poly, axis=0) for poly in polys], dtype=np.float64)
+        return cls.from_bounds(text, confidence, mins[:, 0], maxs[:, 0], mins[:, 1], maxs[:, 1])
+
+    @classmethod
+    def empty(cls):
+        return cls([], {name: np.zeros(0) for name in COLUMNS})
+
+    @classmethod
+    def concat(cls, parts):
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls.empty()
+        names = set.intersection(*(set(part.columns) for part in parts))
+        return cls(
+            np.concatenate([part.text for part in parts]),
+            {name: np.concatenate([part.columns[name] for part in parts]) for name in names}
+        )
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['columns'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __getitem__(self, index):
+        return OCRBoxes(
+            self.text[index],
+            {name: values[index] for name, values in self.columns.items()}
+        )
+
+    def sorted(self, *keys):
+        """Return the boxes sorted by the given columns, first key first"""
+        if len(self) == 0:
+            return self
+        return self[np.lexsort([self.columns[key] for key in reversed(keys)])]
+
+    def shift(self, dx, dy):
+        """Move the boxes by (dx, dy) pixels, in place"""
+        for name in ('x_min', 'x_max', 'x_center'):
+            self.columns[name] = self.columns[name] + dx
+        for name in ('y_min', 'y_max', 'y_center'):
+            self.columns[name] = self.columns[name] + dy
+        return self
+
+    def scale(self, factor):
+        """Multiply all pixel coordinates by factor, in place"""
+        for name in COLUMNS:
+            if name != 'confidence':
+                self.columns[name] = self.columns[name] * factor
+        return self
+
+    def normalize(self, page_width, page_height):
+        """
+        Add box coordinates as fractions of the page size (nx_min, nx_max,
+        nx_center, ny_min, ny_max, ny_center), which the layout rules use.
+        """
+        for axis, size in (('x', page_width), ('y', page_height)):
+            for part in ('min', 'max', 'center'):
+                self.columns[f'n{axis}_{part}'] = self.columns[f'{axis}_{part}'] / size
+        return self
+
+    def records(self):
+        """Return the boxes as a list of dicts with one key per column plus 'text'"""
+        names = ('text', *self.columns)
+        columns = [self.text.tolist()] + [values.tolist() for values in self.columns.values()]
+        return [dict(zip(names, values)) for values in zip(*columns)]
+
+    def to_dict(self, precision=DICT_PRECISION):
+        """
+        Compact JSON-serializable form: one list per pixel column, plus texts,
+        and the normalized bounds if normalize() was called.
+        """
+        data = {
+            'text': self.text.tolist(),
+            'confidence': np.round(self.columns['confidence'], 4).tolist(),
+            **{
+                name: np.round(self.columns[name], precision).tolist()
+                for name in ('x_min', 'x_max', 'y_min', 'y_max')
+            }
+        }
+        if 'nx_min' in self.columns:
+            for name in ('nx_min', 'nx_max', 'ny_min', 'ny_max'):
+                data[name] = np.round(self.columns[name], NORMALIZED_PRECISION).tolist()
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild boxes saved with to_dict()"""
+        boxes = cls.from_bounds(
+            data['text'], data['confidence'],
+            data['x_min'], data['x_max'], data['y_min'], data['y_max']
+        )
+        if 'nx_min' in data:
+            for axis in ('x', 'y'):
+                low = np.asarray(data[f'n{axis}_min'], dtype=np.float64)
+                high = np.asarray(data[f'n{axis}_max'], dtype=np.float64)
+                boxes.columns[f'n{axis}_min'] = low
+                boxes.columns[f'n{axis}_max'] = high
+                boxes.columns[f'n{axis}_center'] = (low + high) / 2
+        return boxes
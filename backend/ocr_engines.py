@@ -0,0 +1,448 @@
+"""
+OCR Engines Module
+Interchangeable OCR backends (PaddleOCR 2.x, PaddleOCR 3.x, Tesseract, recorded-fixture replay) behind one interface.
+"""
+
+import hashlib
+import importlib.metadata
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from ocr_boxes import OCRBoxes
+from stages import stage
+
+
+# Configuration
+OCR_ENGINE = os.environ.get("OCR_ENGINE", "auto")  # auto, paddle2, paddle3, tesseract or replay
+OCR_FIXTURE_DIR = os.environ.get(
+    "OCR_FIXTURE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+)
+OCR_RECORD = os.environ.get("OCR_RECORD", "0") == "1"  # save every engine result as a fixture
+
+# Page orientation is decided from the angle classifier's answer for this
+# many text crops; crops are classified one by one only if any of those
+# answers is below ORIENTATION_CONFIDENCE or they disagree
+ORIENTATION_SAMPLES = 5
+ORIENTATION_CONFIDENCE = 0.9
+
+# Text crops recognized per batch by PaddleOCR 3.x, as PaddleOCR 2.x does
+RECOGNITION_BATCH_SIZE = 6
+
+# Tesseract returns whole lines; a gap wider than this many word heights
+# splits a line into separate boxes, like PaddleOCR's detector does
+TESSERACT_WORD_GAP = 1.5
+
+
+def _keep_boxes(boxes, keep):
+    """Apply an OCREngine.run() `keep` filter to recognized boxes"""
+    if keep is None or len(boxes) == 0:
+        return boxes
+    return boxes[keep(np.column_stack([boxes.x_center, boxes.y_center]))]
+
+
+def _keep_detected(dt_boxes, keep):
+    """Apply an OCREngine.run() `keep` filter to detected (n, 4, 2) polygons, before recognition"""
+    dt_boxes = np.asarray(dt_boxes, dtype=np.float32).reshape(-1, 4, 2)
+    if keep is None or len(dt_boxes) == 0:
+        return dt_boxes
+    centers = (dt_boxes.min(axis=1) + dt_boxes.max(axis=1)) / 2
+    return dt_boxes[keep(centers)]
+
+
+class OCREngine:
+    """
+    Interface of an OCR backend. Every engine turns a BGR image into
+    OCRBoxes in that image's pixel coordinates, so the layout code does
+    not depend on which one is deployed.
+    """
+
+    name = None
+
+    def load(self):
+        """Load the models. Called once, when the engine is created."""
+
+    def warmup_engine(self):
+        """The engine warm_up() runs a dummy inference on, or None if there is nothing to warm"""
+        return self
+
+    def run(self, image, progress=None, cancel=None, timings=None, keep=None):
+        """
+        Detect and recognize the text in an image.
+
+        Args:
+            image: BGR image as numpy array
+            progress: Optional callback called with the name of each stage
+            cancel: Optional event; work stops at the next stage boundary once it is set
+            timings: Optional dict that receives the seconds spent per stage
+            keep: Optional function taking an (n, 2) array of box centers and
+                returning a mask of the boxes whose text is wanted. Engines that
+                detect separately skip recognition of the other boxes.
+
+        Returns:
+            OCRBoxes
+        """
+        raise NotImplementedError
+
+
+def crop_text_box(img, box):
+    """
+    Cut a (possibly rotated) text box out of the image as an upright strip,
+    the same way PaddleOCR crops boxes between detection and recognition.
+    """
+    points = np.asarray(box, dtype=np.float32)
+    width = int(max(np.linalg.norm(points[0] - points[1]), np.linalg.norm(points[2] - points[3])))
+    height = int(max(np.linalg.norm(points[0] - points[3]), np.linalg.norm(points[1] - points[2])))
+    width, height = max(width, 1), max(height, 1)
+
+    target = np.float32([[0, 0], [width, 0], [width, height], [0, height]])
+    matrix = cv2.getPerspectiveTransform(points, target)
+    crop = cv2.warpPerspective(
+        img, matrix, (width, height),
+        borderMode=cv2.BORDER_REPLICATE, flags=cv2.INTER_CUBIC
+    )
+
+    # Vertical text
+    if height / width >= 1.5:
+        crop = np.rot90(crop)
+    return crop
+
+
+def page_orientation(classify, crops):
+    """
+    Decide which way up a page is from the angle classifier's answer for
+    the ORIENTATION_SAMPLES widest text crops, which it reads most reliably.
+
+    Args:
+        classify: Function taking a list of crops and returning one
+            (label, score) per crop, with label '0' or '180'
+        crops: Text crops of the page
+
+    Returns:
+        '0' or '180' if every sampled crop is confidently that way up,
+        otherwise None
+    """
+    widest = sorted(range(len(crops)), key=lambda i: crops[i].shape[1], reverse=True)
+    answers = classify([crops[i] for i in widest[:ORIENTATION_SAMPLES]])
+    labels = {label for label, score in answers if score >= ORIENTATION_CONFIDENCE}
+    confident = sum(1 for _, score in answers if score >= ORIENTATION_CONFIDENCE)
+    if answers and confident == len(answers) and labels in ({'0'}, {'180'}):
+        return labels.pop()
+    return None
+
+
+def orient_crops(classify, crops):
+    """
+    Turn text crops upright with as few angle classifier runs as possible.
+
+    Bills are almost always photographed upright, so the classifier first
+    runs once on a sample of the crops (see page_orientation). If the page
+    is confidently upright (or upside down) that answer is applied to every
+    crop; only otherwise is each crop classified, and turned if it is
+    confidently upside down.
+
+    Args:
+        classify: Function taking a list of crops and returning one
+            (label, score) per crop, with label '0' or '180'
+        crops: Text crops of the page
+    """
+    if len(crops) > ORIENTATION_SAMPLES:
+        orientation = page_orientation(classify, crops)
+        if orientation == '0':
+            return crops
+        if orientation == '180':
+            return [cv2.rotate(crop, cv2.ROTATE_180) for crop in crops]
+
+    return [
+        cv2.rotate(crop, cv2.ROTATE_180) if label == '180' and score >= ORIENTATION_CONFIDENCE else crop
+        for crop, (label, score) in zip(crops, classify(crops))
+    ]
+
+
+class PaddleV2Engine(OCREngine):
+    """
+    PaddleOCR 2.x, driven stage by stage: detection, then recognition of the
+    wanted boxes only, so cancellation is checked in between.
+    """
+
+    name = 'paddle2'
+
+    def load(self):
+        from paddleocr import PaddleOCR
+        self.ocr = PaddleOCR(use_angle_cls=True, lang='en')
+
+    def run(self, image, progress=None, cancel=None, timings=None, keep=None):
+        ocr = self.ocr
+        with stage('detection', progress, cancel, timings):
+            dt_boxes, _ = ocr.text_detector(image)
+        if dt_boxes is None or len(dt_boxes) == 0:
+            return OCRBoxes.empty()
+
+        dt_boxes = _keep_detected(dt_boxes, keep)
+        if len(dt_boxes) == 0:
+            return OCRBoxes.empty()
+
+        with stage('recognition', progress, cancel, timings):
+            crops = [crop_text_box(image, box) for box in dt_boxes]
+            if ocr.use_angle_cls:
+                crops = orient_crops(lambda sample: ocr.text_classifier(sample)[1], crops)
+            rec_res, _ = ocr.text_recognizer(crops)
+
+        found = [
+            (box, str(text).strip(), float(score))
+            for box, (text, score) in zip(dt_boxes, rec_res)
+            if score >= ocr.drop_score
+        ]
+        return OCRBoxes.from_polys(
+            [text for _, text, _ in found],
+            [score for _, _, score in found],
+            [box for box, _, _ in found]
+        )
+
+
+class PaddleV3Engine(OCREngine):
+    """
+    PaddleOCR 3.x, driven stage by stage like PaddleV2Engine through its
+    separate text detection, line orientation and recognition models:
+    detection, then recognition of the wanted boxes only, turned upright as
+    in orient_crops().
+    """
+
+    name = 'paddle3'
+
+    def load(self):
+        from paddleocr import TextDetection, TextLineOrientationClassification, TextRecognition
+        # Detection input size as in the PaddleOCR 3.x OCR pipeline
+        self.detector = TextDetection(limit_side_len=64, limit_type='min')
+        self.classifier = TextLineOrientationClassification()
+        self.recognizer = TextRecognition()
+
+    def _classify(self, crops):
+        """(label, score) per crop, with labels '0' or '180' as in PaddleOCR 2.x"""
+        return [
+            (str(result['label_names'][0]).split('_')[0], float(result['scores'][0]))
+            for result in self.classifier.predict(crops)
+        ]
+
+    def run(self, image, progress=None, cancel=None, timings=None, keep=None):
+        with stage('detection', progress, cancel, timings):
+            results = self.detector.predict(image)
+        if not results or results[0] is None:
+            return OCRBoxes.empty()
+
+        dt_boxes = _keep_detected(results[0].get('dt_polys', []), keep)
+        if len(dt_boxes) == 0:
+            return OCRBoxes.empty()
+
+        with stage('recognition', progress, cancel, timings):
+            crops = orient_crops(self._classify, [crop_text_box(image, box) for box in dt_boxes])
+            rec_res = self.recognizer.predict(crops, batch_size=RECOGNITION_BATCH_SIZE)
+
+        return OCRBoxes.from_polys(
+            [str(result['rec_text']).strip() for result in rec_res],
+            [float(result['rec_score']) for result in rec_res],
+            dt_boxes
+        )
+
+
+def parse_tesseract_data(data):
+    """
+    Convert pytesseract.image_to_data() output to OCRBoxes, joining words
+    into text boxes the way PaddleOCR detects them: one box per run of
+    words on a line, split where the gap between words is wide.
+    """
+    lines = {}
+    for i, word in enumerate(data['text']):
+        word = str(word).strip()
+        confidence = float(data['conf'][i])
+        if not word or confidence < 0:
+            continue
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        left, top = data['left'][i], data['top'][i]
+        lines.setdefault(key, []).append(
+            (left, top, left + data['width'][i], top + data['height'][i], word, confidence)
+        )
+
+    texts, confidences, x_min, x_max, y_min, y_max = [], [], [], [], [], []
+
+    def add(words):
+        texts.append(' '.join(word[4] for word in words))
+        confidences.append(sum(word[5] for word in words) / len(words) / 100)
+        x_min.append(min(word[0] for word in words))
+        y_min.append(min(word[1] for word in words))
+        x_max.append(max(word[2] for word in words))
+        y_max.append(max(word[3] for word in words))
+
+    for words in lines.values():
+        words.sort()
+        run = [words[0]]
+        for word in words[1:]:
+            height = max(word[3] - word[1], run[-1][3] - run[-1][1], 1)
+            if word[0] - run[-1][2] > TESSERACT_WORD_GAP * height:
+                add(run)
+                run = []
+            run.append(word)
+        add(run)
+
+    if not texts:
+        return OCRBoxes.empty()
+    return OCRBoxes.from_bounds(texts, confidences, x_min, x_max, y_min, y_max)
+
+
+class TesseractEngine(OCREngine):
+    """Tesseract through pytesseract: no Paddle runtime needed"""
+
+    name = 'tesseract'
+
+    def load(self):
+        import pytesseract
+        self.pytesseract = pytesseract
+        # Fails here, at startup, if the tesseract binary is missing
+        pytesseract.get_tesseract_version()
+
+    def run(self, image, progress=None, cancel=None, timings=None, keep=None):
+        with stage('ocr', progress, cancel, timings):
+            data = self.pytesseract.image_to_data(
+                cv2.cvtColor(image, cv2.COLOR_BGR2RGB),
+                output_type=self.pytesseract.Output.DICT
+            )
+        return _keep_boxes(parse_tesseract_data(data), keep)
+
+
+def image_key(image):
+    """SHA-256 of an image's shape and pixels, which names its fixture"""
+    digest = hashlib.sha256(repr(image.shape).encode('utf-8'))
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+def fixture_path(key, directory=None):
+    return os.path.join(directory or OCR_FIXTURE_DIR, key + '.json')
+
+
+def save_fixture(path, boxes, image, source=None):
+    """
+    Save an engine's boxes for one image as a compact JSON fixture:
+    {"width": ..., "height": ..., "source": ..., "boxes": OCRBoxes.to_dict()}
+    """
+    fixture = {'width': image.shape[1], 'height': image.shape[0]}
+    if source:
+        fixture['source'] = source
+    fixture['boxes'] = boxes.to_dict()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(fixture, f, separators=(',', ':'))
+
+
+def load_fixture(path):
+    """
+    Returns:
+        (boxes, width, height): the recorded OCRBoxes and the size of the
+        image they were found in
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        fixture = json.load(f)
+    return OCRBoxes.from_dict(fixture['boxes']), fixture['width'], fixture['height']
+
+
+class ReplayEngine(OCREngine):
+    """
+    Returns the boxes recorded for the exact same image (see RecordingEngine),
+    so the pipeline runs deterministically and without any model installed.
+    """
+
+    name = 'replay'
+
+    def __init__(self, directory=None):
+        self.directory = directory or OCR_FIXTURE_DIR
+
+    def warmup_engine(self):
+        # No models, and no fixture for the dummy image
+        return None
+
+    def run(self, image, progress=None, cancel=None, timings=None, keep=None):
+        with stage('ocr', progress, cancel, timings):
+            path = fixture_path(image_key(image), self.directory)
+            if not os.path.exists(path):
+                raise LookupError(f"No OCR fixture for this image in {self.directory}")
+            boxes, _, _ = load_fixture(path)
+        return _keep_boxes(boxes, keep)
+
+
+class RecordingEngine(OCREngine):
+    """
+    Wraps another engine and saves each of its results as a fixture for
+    ReplayEngine. Every box is recognized and recorded; the `keep` filter
+    is applied afterwards, so fixtures do not depend on the zone settings.
+    """
+
+    def __init__(self, engine, directory=None):
+        self.engine = engine
+        self.name = engine.name
+        self.directory = directory or OCR_FIXTURE_DIR
+        self.source = None  # optional image name stored in the fixtures
+
+    def load(self):
+        self.engine.load()
+
+    def warmup_engine(self):
+        # Warm the wrapped engine directly, so the dummy image is not recorded
+        return self.engine.warmup_engine()
+
+    def run(self, image, progress=None, cancel=None, timings=None, keep=None):
+        boxes = self.engine.run(image, progress=progress, cancel=cancel, timings=timings)
+        save_fixture(fixture_path(image_key(image), self.directory), boxes, image, self.source)
+        return _keep_boxes(boxes, keep)
+
+
+ENGINES = {
+    engine.name: engine
+    for engine in (PaddleV2Engine, PaddleV3Engine, TesseractEngine, ReplayEngine)
+}
+
+
+def resolve_engine_name(name=OCR_ENGINE):
+    """
+    Resolve 'auto' to an engine name from the installed PaddleOCR version,
+    read from the package metadata so paddle itself is not imported.
+    """
+    if name != 'auto':
+        return name
+    try:
+        version = importlib.metadata.version('paddleocr')
+    except importlib.metadata.PackageNotFoundError:
+        return 'tesseract'
+    return 'paddle2' if int(version.split('.')[0]) < 3 else 'paddle3'
+
+
+ENGINE_NAME = resolve_engine_name()
+
+# Created once per process for reuse
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Get or create the configured OCR engine (singleton pattern)"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                if ENGINE_NAME not in ENGINES:
+                    raise ValueError(f"Unknown OCR engine: {ENGINE_NAME}")
+                engine = ENGINES[ENGINE_NAME]()
+                if OCR_RECORD:
+                    engine = RecordingEngine(engine)
+                engine.load()
+                _engine = engine
+    return _engine
+
+
+def set_engine(engine):
+    """Use an already loaded engine for this process, e.g. a RecordingEngine in a tool"""
+    global _engine
+    with _engine_lock:
+        _engine = engine
@@ -1,35 +1,383 @@
 """
 OCR Service Module
-Extracts text and structured data from bill/invoice images using PaddleOCR.
+Extracts text and structured data from bill/invoice images using PaddleOCR (or another engine from ocr_engines).
 """
 
 import cv2
+import numpy as np
 import os
 import re
-import tempfile
-from paddleocr import PaddleOCR
+import time
+from bisect import bisect_right
+from difflib import SequenceMatcher
+from functools import lru_cache
 
+from ocr_boxes import OCRBoxes
+from ocr_engines import get_engine, ENGINE_NAME
+from layout_templates import COLUMN_LABELS, LayoutTemplate, find_header_row, get_registry
+from stages import ProcessingCancelled, stage
 
-# Initialize PaddleOCR globally for reuse
-_ocr_instance = None
 
+# Pipeline parameters
+MAX_IMAGE_WIDTH = int(os.environ.get("OCR_MAX_IMAGE_WIDTH", 1600))  # wider images are downscaled; 0 disables
+CROP_DOCUMENT = os.environ.get("OCR_CROP_DOCUMENT", "1") == "1"  # crop to the detected bill
+CORRECT_PERSPECTIVE = os.environ.get("OCR_CORRECT_PERSPECTIVE", "0") == "1"  # also flatten it
+TILE_SIZE = int(os.environ.get("OCR_TILE_SIZE", 0))  # OCR larger images in tiles this big; 0 disables
+TILE_OVERLAP = int(os.environ.get("OCR_TILE_OVERLAP", 200))  # must exceed the largest text box
+DENOISE_MODE = os.environ.get("OCR_DENOISE", "auto")  # none, median, bilateral, nlmeans or auto
+DENOISE_STRENGTH = 5
+APPLY_OTSU = False
 
-def get_ocr():
-    """Get or create PaddleOCR instance (singleton pattern)"""
-    global _ocr_instance
-    if _ocr_instance is None:
-        _ocr_instance = PaddleOCR(use_angle_cls=True, lang='en')
-    return _ocr_instance
+# Document detection runs on a copy this wide; contours smaller than
+# DOCUMENT_MIN_AREA of the image are ignored, and a crop that keeps more than
+# DOCUMENT_MAX_AREA of it is not worth doing
+DOCUMENT_DETECT_WIDTH = 500
+DOCUMENT_MIN_AREA = 0.2
+DOCUMENT_MAX_AREA = 0.9
+DOCUMENT_MARGIN = 0.01
 
+# A quadrilateral is only taken for the page if the image around it is
+# nearly blank: at most DOCUMENT_MAX_OUTSIDE_EDGES of the pixels outside it
+# (past a band of DOCUMENT_BORDER_BAND of the width along its outline) may
+# be edges. Otherwise it is something printed on the page, such as the
+# ruled border of the item table on a flat scan, and cropping to it would
+# cut off the bill's header.
+DOCUMENT_MAX_OUTSIDE_EDGES = 0.02
+DOCUMENT_BORDER_BAND = 0.02
 
-def preprocess_image(input_path, denoise_strength=5, apply_otsu=False):
+# Tiled OCR: boxes within TILE_EDGE_MARGIN pixels of an inner tile edge may be
+# cut off and are left to the neighbouring tile. Boxes from different tiles are
+# the same text if they overlap this much and their texts are this similar.
+# Cut pieces of a box no tile sees whole are joined if they share a line by
+# TILE_LINE_OVERLAP of the smaller height, and their texts by a common run of
+# at least TILE_STITCH_CHARS characters.
+TILE_EDGE_MARGIN = 2
+TILE_IOU = 0.5
+TILE_CONTAINMENT = 0.8
+TILE_TEXT_SIMILARITY = 0.6
+TILE_LINE_OVERLAP = 0.5
+TILE_STITCH_CHARS = 2
+
+if TILE_SIZE and TILE_SIZE <= TILE_OVERLAP:
+    raise ValueError(f"OCR_TILE_SIZE ({TILE_SIZE}) must be larger than OCR_TILE_OVERLAP ({TILE_OVERLAP})")
+
+# Noise levels (estimated sigma, in gray levels) at which 'auto' denoising
+# switches from nothing to a median filter, and from median to non-local means
+NOISE_LOW = 2.0
+NOISE_HIGH = 4.0
+
+# Layout geometry. The layout rules work in coordinates normalized to the page
+# (0..1 across its width and height), so the same bill gives the same result
+# at any resolution. The constants are written in pixels of the bill they were
+# tuned on (993 x 1280) and converted to page fractions here.
+REFERENCE_WIDTH = 993
+REFERENCE_HEIGHT = 1280
+
+
+def _ref_x(px):
+    return px / REFERENCE_WIDTH
+
+
+def _ref_y(px):
+    return px / REFERENCE_HEIGHT
+
+
+HEADER_ZONE_BOTTOM = _ref_y(300)
+
+# Header fields. The customer name is looked for left of NAME_ZONE_RIGHT
+# between NAME_ZONE_TOP and NAME_ZONE_BOTTOM, ignoring boxes that contain any
+# of NAME_EXCLUDE or of the bill's layout template's name_exclude. The Sl. No
+# is expected within SL_NO_LOOKAHEAD boxes of its label.
+NAME_ZONE_TOP = _ref_y(80)
+NAME_ZONE_BOTTOM = _ref_y(220)
+NAME_ZONE_RIGHT = _ref_x(300)
+NAME_EXCLUDE = ('darpan', 'glass', 'ply', 'concepts', 'email',
+                'phone', 'contact', 'www', '.com', 'sl', 'no',
+                'date', 'bill', 'mrp', 'particulars', 'qty',
+                'rate', 'total', '080', '297')
+SL_NO_LOOKAHEAD = 5
+
+# Compiled once: every header box is matched against these. The exclude
+# keywords are a single alternation, so each box is scanned once for all.
+_NAME_NOISE_PATTERN = re.compile('|'.join(re.escape(keyword) for keyword in NAME_EXCLUDE))
+_LETTER_PATTERN = re.compile(r'[a-zA-Z]')
+_SL_NO_PATTERN = re.compile(r'^\d{2,6}$')
+_DATE_PATTERN = re.compile(r'\.?(\d{1,2})[\|/\.\s]*(\d{1,2})[\|/\.\s]*(\d{2,4})')
+
+# Boxes are in the same table row if their centers are within
+# ROW_HEIGHT_FACTOR median box heights of the row's baseline, or if their
+# vertical extents overlap the row by ROW_OVERLAP of the smaller height. The
+# baseline moves ROW_BASELINE_WEIGHT of the way to each box added.
+ROW_HEIGHT_FACTOR = 0.5
+ROW_OVERLAP = 0.5
+ROW_BASELINE_WEIGHT = 0.5
+
+# The table ends at the first line below its header row naming a total (but
+# not a sub total) or the signature. Without a header row it starts below
+# HEADER_ZONE_BOTTOM.
+_FOOTER_PATTERN = re.compile(r'total|signature')
+
+# Column boundaries used when a bill matches no layout template: MRP,
+# particulars, qty, rate and total, left to right
+COLUMN_BOUNDARIES = (_ref_x(150), _ref_x(500), _ref_x(660), _ref_x(850))
+
+# Page zones (left, top, right, bottom) whose text the layout rules never use:
+# the shop name and address left of the Sl. No / date column above the
+# customer name, and the signature strip below the table. Boxes detected
+# there are not recognized.
+SKIP_ZONES = os.environ.get("OCR_SKIP_ZONES", "1") == "1"
+SKIPPED_ZONES = [
+    (0.0, 0.0, _ref_x(600), _ref_y(80)),
+    (0.0, _ref_y(1230), 1.0, 1.0),
+]
+
+# Everything that changes the output for a given image, except the layout
+# templates, which are applied again to the cached OCR boxes on every cache
+# hit. Used as part of the result cache key, so bump PIPELINE_VERSION when the
+# extraction logic changes.
+PIPELINE_VERSION = 8
+PIPELINE_PARAMS = {
+    'version': PIPELINE_VERSION,
+    'engine': ENGINE_NAME,
+    'max_image_width': MAX_IMAGE_WIDTH,
+    'crop_document': CROP_DOCUMENT,
+    'correct_perspective': CORRECT_PERSPECTIVE,
+    'tile_size': TILE_SIZE,
+    'tile_overlap': TILE_OVERLAP,
+    'denoise_mode': DENOISE_MODE,
+    'denoise_strength': DENOISE_STRENGTH,
+    'apply_otsu': APPLY_OTSU,
+    'row_height_factor': ROW_HEIGHT_FACTOR,
+    'row_overlap': ROW_OVERLAP,
+    'row_baseline_weight': ROW_BASELINE_WEIGHT,
+    'column_boundaries': [round(v, 6) for v in COLUMN_BOUNDARIES],
+    'skipped_zones': [[round(v, 6) for v in zone] for zone in SKIPPED_ZONES] if SKIP_ZONES else []
+}
+
+
+def warm_up():
     """
-    Preprocess bill image for better OCR accuracy.
+    Load the OCR engine's models and run one dummy inference, so the first
+    real request does not pay for lazy initialization. Engines with nothing
+    to warm, like the fixture replay, skip the inference.
+    
+    Returns:
+        Dict with the engine name and the model load and warmup inference
+        times in seconds
+    """
+    start = time.perf_counter()
+    engine = get_engine().warmup_engine()
+    loaded = time.perf_counter()
+    
+    if engine is not None:
+        img = np.full((64, 320, 3), 255, dtype=np.uint8)
+        cv2.putText(img, 'INVOICE 123', (10, 45), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (0, 0, 0), 2)
+        run_ocr(engine, img)
+    
+    return {
+        'engine': ENGINE_NAME,
+        'modelLoadSeconds': round(loaded - start, 3),
+        'warmupSeconds': round(time.perf_counter() - loaded, 3)
+    }
+
+
+def decode_image(buf):
+    """
+    Decode an encoded image (JPEG, PNG, ...) held in memory.
     
     Args:
-        input_path: Path to input image
-        denoise_strength: Strength for denoising (default: 5)
-        apply_otsu: Apply Otsu thresholding (default: False)
+        buf: bytes, bytearray or memoryview with the encoded image
+    
+    Returns:
+        BGR image as numpy array, or None if the data is not a valid image
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    if data.size == 0:
+        return None
+    return cv2.imdecode(data, cv2.IMREAD_COLOR)
+
+
+def normalize_resolution(img, max_width=MAX_IMAGE_WIDTH):
+    """
+    Downscale an image to at most `max_width` pixels wide, keeping its aspect
+    ratio, so preprocessing and OCR cost stay bounded whatever camera took
+    the photo. Smaller images are left untouched.
+    
+    Returns:
+        (image, scale) where scale converts normalized coordinates back to
+        original ones (original = normalized * scale)
+    """
+    height, width = img.shape[:2]
+    if not max_width or width <= max_width:
+        return img, 1.0
+    
+    scale = width / max_width
+    resized = cv2.resize(
+        img, (max_width, max(1, round(height / scale))),
+        interpolation=cv2.INTER_AREA
+    )
+    return resized, scale
+
+
+def scale_boxes(boxes, scale, offset=(0, 0)):
+    """
+    Map OCRBoxes pixel coordinates from a cropped, normalized image back to
+    the original image: shift by the crop `offset` (x, y), then multiply by
+    `scale`. The normalized coordinates are unchanged.
+    """
+    dx, dy = offset
+    if dx or dy:
+        boxes.shift(dx, dy)
+    if scale != 1.0:
+        boxes.scale(scale)
+    return boxes
+
+
+def _order_corners(points):
+    """Order 4 points as top-left, top-right, bottom-right, bottom-left"""
+    points = np.asarray(points, dtype=np.float32)
+    sums = points.sum(axis=1)
+    diffs = np.diff(points, axis=1).ravel()
+    return np.float32([
+        points[np.argmin(sums)], points[np.argmin(diffs)],
+        points[np.argmax(sums)], points[np.argmax(diffs)]
+    ])
+
+
+def find_document(img):
+    """
+    Find the bill in a photo as the largest convex quadrilateral contour
+    with nearly no edges outside it (see DOCUMENT_MAX_OUTSIDE_EDGES).
+    Runs on a small copy of the image, so it costs a few milliseconds.
+    
+    Returns:
+        Corners (top-left, top-right, bottom-right, bottom-left) in image
+        coordinates, or None if no clear page outline was found
+    """
+    height, width = img.shape[:2]
+    factor = min(1.0, DOCUMENT_DETECT_WIDTH / width)
+    small = cv2.resize(img, (max(1, round(width * factor)), max(1, round(height * factor))),
+                       interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    
+    edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), dtype=np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    
+    min_area = DOCUMENT_MIN_AREA * small.shape[0] * small.shape[1]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        if cv2.contourArea(contour) < min_area:
+            break
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx) and _blank_outside(edges, approx):
+            return _order_corners(approx.reshape(4, 2) / factor)
+    return None
+
+
+def _blank_outside(edges, quad):
+    """Whether at most DOCUMENT_MAX_OUTSIDE_EDGES of the pixels around quad are edges"""
+    inside = np.zeros_like(edges)
+    cv2.fillPoly(inside, [quad.reshape(-1, 2).astype(np.int32)], 255)
+    band = max(1, round(DOCUMENT_BORDER_BAND * edges.shape[1]))
+    inside = cv2.dilate(inside, np.ones((2 * band + 1, 2 * band + 1), dtype=np.uint8))
+    outside = inside == 0
+    if not outside.any():
+        return True
+    return np.count_nonzero(edges[outside]) <= DOCUMENT_MAX_OUTSIDE_EDGES * np.count_nonzero(outside)
+
+
+def crop_to_document(img, correct_perspective=CORRECT_PERSPECTIVE):
+    """
+    Crop a photo to the bill so OCR only scans the document area.
+    
+    Returns:
+        (image, offset) where offset is the (x, y) position of the crop in
+        the input image. With perspective correction the bill is warped flat
+        and coordinates are those of the flattened page, so offset is (0, 0).
+        The input is returned unchanged if no bill outline is found or the
+        bill already fills the frame.
+    """
+    corners = find_document(img)
+    if corners is None:
+        return img, (0, 0)
+    
+    height, width = img.shape[:2]
+    if cv2.contourArea(corners) > DOCUMENT_MAX_AREA * width * height:
+        return img, (0, 0)
+    
+    if correct_perspective:
+        top_left, top_right, bottom_right, bottom_left = corners
+        page_width = int(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left)))
+        page_height = int(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right)))
+        target = np.float32([[0, 0], [page_width, 0], [page_width, page_height], [0, page_height]])
+        matrix = cv2.getPerspectiveTransform(corners, target)
+        return cv2.warpPerspective(img, matrix, (page_width, page_height),
+                                   borderMode=cv2.BORDER_REPLICATE), (0, 0)
+    
+    margin_x, margin_y = DOCUMENT_MARGIN * width, DOCUMENT_MARGIN * height
+    x0 = max(0, int(corners[:, 0].min() - margin_x))
+    y0 = max(0, int(corners[:, 1].min() - margin_y))
+    x1 = min(width, int(np.ceil(corners[:, 0].max() + margin_x)))
+    y1 = min(height, int(np.ceil(corners[:, 1].max() + margin_y)))
+    return img[y0:y1, x0:x1], (x0, y0)
+
+
+def estimate_noise(gray):
+    """
+    Estimate the noise standard deviation of a grayscale image from the
+    high-pass residual of a single 3x3 filter (Immerkaer's method).
+    Costs one convolution, far less than any denoiser.
+    """
+    kernel = np.array([[1, -2, 1], [-2, 4, -2], [1, -2, 1]], dtype=np.float32)
+    residual = cv2.filter2D(gray.astype(np.float32), -1, kernel)[1:-1, 1:-1]
+    if residual.size == 0:
+        return 0.0
+    return float(np.sqrt(np.pi / 2) * np.abs(residual).mean() / 6)
+
+
+def choose_denoise_mode(gray):
+    """Pick the cheapest denoiser that suits the estimated noise level"""
+    sigma = estimate_noise(gray)
+    if sigma < NOISE_LOW:
+        return 'none'
+    if sigma < NOISE_HIGH:
+        return 'median'
+    return 'nlmeans'
+
+
+def denoise(gray, mode=DENOISE_MODE, strength=DENOISE_STRENGTH):
+    """
+    Denoise a grayscale image.
+    
+    Args:
+        gray: Grayscale image as numpy array
+        mode: 'none', 'median', 'bilateral', 'nlmeans', or 'auto' to choose
+            from the estimated noise level
+        strength: Filter strength for non-local means
+    """
+    if mode == 'auto':
+        mode = choose_denoise_mode(gray)
+    
+    if mode == 'none':
+        return gray
+    if mode == 'median':
+        return cv2.medianBlur(gray, 3)
+    if mode == 'bilateral':
+        return cv2.bilateralFilter(gray, 5, 50, 50)
+    if mode == 'nlmeans':
+        return cv2.fastNlMeansDenoising(
+            gray, None, h=strength, 
+            templateWindowSize=7, searchWindowSize=21
+        )
+    raise ValueError(f"Unknown denoise mode: {mode}")
+
+
+def preprocess_image(input_path, denoise_strength=DENOISE_STRENGTH, apply_otsu=APPLY_OTSU,
+                     denoise_mode=DENOISE_MODE):
+    """
+    Preprocess bill image file for better OCR accuracy.
+    See preprocess_array() for the in-memory version.
     
     Returns:
         Preprocessed image as numpy array, or None if failed
@@ -37,12 +385,25 @@ def preprocess_image(input_path, denoise_strength=5, apply_otsu=False):
     img = cv2.imread(input_path)
     if img is None:
         return None
+    return preprocess_array(img, denoise_strength, apply_otsu, denoise_mode)
+
+
+def preprocess_array(img, denoise_strength=DENOISE_STRENGTH, apply_otsu=APPLY_OTSU,
+                     denoise_mode=DENOISE_MODE):
+    """
+    Preprocess bill image for better OCR accuracy.
     
+    Args:
+        img: BGR image as numpy array
+        denoise_strength: Strength for denoising (default: 5)
+        apply_otsu: Apply Otsu thresholding (default: False)
+        denoise_mode: Denoising strategy, see denoise() (default: OCR_DENOISE or 'auto')
+    
+    Returns:
+        Preprocessed grayscale image as numpy array
+    """
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    denoised = cv2.fastNlMeansDenoising(
-        gray, None, h=denoise_strength, 
-        templateWindowSize=7, searchWindowSize=21
-    )
+    denoised = denoise(gray, denoise_mode, denoise_strength)
     
     if apply_otsu:
         _, processed = cv2.threshold(
@@ -55,241 +416,477 @@ def preprocess_image(input_path, denoise_strength=5, apply_otsu=False):
     return processed
 
 
-def extract_ocr_data(image_path):
+def zone_filter(page):
+    """
+    Build the OCREngine.run() `keep` filter that drops boxes whose center
+    lies in one of SKIPPED_ZONES, whose text the layout rules never use.
+    
+    Args:
+        page: (x, y, width, height): position of the image on the page
+            (non-zero for tiles) and the page size
+    """
+    if not SKIP_ZONES:
+        return None
+    x0, y0, width, height = page
+    
+    def keep(centers):
+        nx = (centers[:, 0] + x0) / width
+        ny = (centers[:, 1] + y0) / height
+        kept = np.ones(len(centers), dtype=bool)
+        for left, top, right, bottom in SKIPPED_ZONES:
+            kept &= ~((nx >= left) & (nx <= right) & (ny >= top) & (ny <= bottom))
+        return kept
+    
+    return keep
+
+
+def run_ocr(engine, image, progress=None, cancel=None, timings=None, page=None):
+    """
+    Run the OCR engine on a BGR image and return OCRBoxes in its pixel coordinates.
+    `page` is the position of the image on the page, see zone_filter(); it
+    defaults to the image being the whole page.
     """
-    Run OCR on image and extract text with coordinates.
-    Supports both PaddleOCR 2.x and 3.x API formats.
+    if page is None:
+        page = (0, 0, image.shape[1], image.shape[0])
+    return engine.run(image, progress=progress, cancel=cancel, timings=timings, keep=zone_filter(page))
+
+
+def tile_grid(width, height, tile_size=None, overlap=None):
+    """
+    Split an image into overlapping tiles covering it completely.
     
     Returns:
-        List of dicts with text, confidence, and bounding box info
+        List of (x0, y0, x1, y1) tile rectangles
     """
-    ocr = get_ocr()
+    tile_size = tile_size or TILE_SIZE
+    overlap = TILE_OVERLAP if overlap is None else overlap
+    if tile_size <= overlap:
+        raise ValueError(f"Tile size {tile_size} must be larger than the overlap {overlap}")
+    step = tile_size - overlap
+    
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        positions = list(range(0, length - tile_size, step))
+        positions.append(length - tile_size)
+        return positions
     
-    # PaddleOCR can use either ocr() or predict() method
-    try:
-        results = ocr.ocr(image_path, cls=True)
-    except Exception:
-        results = ocr.predict(image_path)
+    return [
+        (x0, y0, min(width, x0 + tile_size), min(height, y0 + tile_size))
+        for y0 in starts(height)
+        for x0 in starts(width)
+    ]
+
+
+def _touches_inner_edge(boxes, tile, width, height):
+    """Mask of boxes touching a tile edge that is not an image edge, i.e. that may be cut off"""
+    x0, y0, x1, y1 = tile
+    margin = TILE_EDGE_MARGIN
+    touches = np.zeros(len(boxes), dtype=bool)
+    if x0 > 0:
+        touches |= boxes.x_min - x0 <= margin
+    if y0 > 0:
+        touches |= boxes.y_min - y0 <= margin
+    if x1 < width:
+        touches |= x1 - boxes.x_max <= margin
+    if y1 < height:
+        touches |= y1 - boxes.y_max <= margin
+    return touches
+
+
+def _box_overlap(a, b):
+    """Return (IoU, intersection over the smaller box) of two boxes"""
+    width = min(a['x_max'], b['x_max']) - max(a['x_min'], b['x_min'])
+    height = min(a['y_max'], b['y_max']) - max(a['y_min'], b['y_min'])
+    if width <= 0 or height <= 0:
+        return 0.0, 0.0
+    intersection = width * height
+    area_a = a['width'] * a['height']
+    area_b = b['width'] * b['height']
+    smaller = min(area_a, area_b)
+    iou = intersection / (area_a + area_b - intersection)
+    return iou, (intersection / smaller if smaller > 0 else 0.0)
+
+
+def _same_text(a, b):
+    a, b = a.lower(), b.lower()
+    if not a or not b or a in b or b in a:
+        return True
+    return SequenceMatcher(None, a, b).ratio() >= TILE_TEXT_SIMILARITY
+
+
+def _grid_cells(box, cell):
+    """Keys of the grid cells of size `cell` that a box dict overlaps"""
+    for gy in range(int(box['y_min'] // cell), int(box['y_max'] // cell) + 1):
+        for gx in range(int(box['x_min'] // cell), int(box['x_max'] // cell) + 1):
+            yield gx, gy
+
+
+def _neighbours(grid, box, cell):
+    """Indices registered in the grid cells a box overlaps"""
+    found = set()
+    for key in _grid_cells(box, cell):
+        found.update(grid.get(key, ()))
+    return found
+
+
+def merge_tile_boxes(boxes, tiles):
+    """
+    Drop boxes found twice in the overlap of neighbouring tiles. Two boxes
+    are duplicates if they mostly overlap (by IoU, or one nearly inside the
+    other) and read the same text; the longer, more confident reading is kept.
+    Each box is only compared with the kept boxes sharing a grid cell with it.
     
-    ocr_data = []
+    Args:
+        boxes: OCRBoxes from all tiles
+        tiles: Array with the index of the tile each box came from
+    """
+    items = boxes.records()
+    ranked = sorted(range(len(items)), key=lambda i: (len(items[i]['text']), items[i]['confidence']), reverse=True)
+    cell = max(TILE_OVERLAP, 1)
+    grid = {}
+    kept = []
+    for i in ranked:
+        duplicate = False
+        for j in _neighbours(grid, items[i], cell):
+            if tiles[i] == tiles[j]:
+                continue
+            iou, containment = _box_overlap(items[i], items[j])
+            if (iou >= TILE_IOU or containment >= TILE_CONTAINMENT) and _same_text(items[i]['text'], items[j]['text']):
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(i)
+            for key in _grid_cells(items[i], cell):
+                grid.setdefault(key, []).append(i)
+    return boxes[np.sort(np.array(kept, dtype=np.intp))]
+
+
+def _stitch_text(left, right):
+    """Join two readings of overlapping pieces of one text, left piece first"""
+    match = SequenceMatcher(None, left, right, autojunk=False).find_longest_match(0, len(left), 0, len(right))
+    if match.size >= min(TILE_STITCH_CHARS, len(left), len(right)) > 0:
+        return left[:match.a] + right[match.b:]
+    return f"{left} {right}".strip()
+
+
+def merge_cut_boxes(pieces, tiles, whole):
+    """
+    Recover boxes too large for the tile overlap, which every tile cuts off.
+    Pieces inside a whole box are dropped. The other pieces are joined with
+    the pieces from other tiles that overlap them on the same line, into
+    one box whose text is stitched together where the readings overlap.
     
-    if not results:
-        return ocr_data
+    Args:
+        pieces: OCRBoxes cut off at an inner tile edge, in image coordinates
+        tiles: Array with the index of the tile each piece came from
+        whole: OCRBoxes that were not cut off, after merge_tile_boxes()
+    """
+    if len(pieces) == 0:
+        return pieces
+    cell = max(TILE_OVERLAP, 1)
     
-    # Handle different result formats
-    # Format 1 (PaddleOCR 2.x): [[[box, (text, confidence)], ...]]
-    # Format 2 (PaddleOCR 3.x): [{'rec_texts': [...], 'dt_polys': [...], ...}]
+    whole_items = whole.records()
+    grid = {}
+    for j, item in enumerate(whole_items):
+        for key in _grid_cells(item, cell):
+            grid.setdefault(key, []).append(j)
+    items = pieces.records()
+    loose = [
+        i for i, item in enumerate(items)
+        if not any(_box_overlap(item, whole_items[j])[1] >= TILE_CONTAINMENT
+                   for j in _neighbours(grid, item, cell))
+    ]
     
-    if isinstance(results, list) and len(results) > 0:
-        first_result = results[0]
-        
-        # Check if it's the new format (dict with rec_texts)
-        if isinstance(first_result, dict) and 'rec_texts' in first_result:
-            texts = first_result.get('rec_texts', [])
-            polys = first_result.get('dt_polys', [])
-            scores = first_result.get('rec_scores', [1.0] * len(texts))
-            
-            for i, (text, poly) in enumerate(zip(texts, polys)):
-                confidence = scores[i] if i < len(scores) else 1.0
-                
-                x_coords = [point[0] for point in poly]
-                y_coords = [point[1] for point in poly]
-                
-                x_min, x_max = min(x_coords), max(x_coords)
-                y_min, y_max = min(y_coords), max(y_coords)
-                
-                ocr_data.append({
-                    'text': str(text).strip(),
-                    'confidence': float(confidence),
-                    'x_min': float(x_min),
-                    'x_max': float(x_max),
-                    'y_min': float(y_min),
-                    'y_max': float(y_max),
-                    'x_center': (x_min + x_max) / 2,
-                    'y_center': (y_min + y_max) / 2,
-                    'width': x_max - x_min,
-                    'height': y_max - y_min
-                })
-        
-        # Old format (list of [box, (text, confidence)])
-        elif isinstance(first_result, list):
-            for page_result in results:
-                if page_result is None:
-                    continue
-                for item in page_result:
-                    if item is None or len(item) < 2:
-                        continue
-                    
-                    box = item[0]
-                    text_info = item[1]
-                    
-                    if isinstance(text_info, tuple) and len(text_info) >= 2:
-                        text = str(text_info[0]).strip()
-                        confidence = float(text_info[1])
-                    else:
-                        text = str(text_info).strip()
-                        confidence = 1.0
-                    
-                    x_coords = [point[0] for point in box]
-                    y_coords = [point[1] for point in box]
-                    
-                    x_min, x_max = min(x_coords), max(x_coords)
-                    y_min, y_max = min(y_coords), max(y_coords)
-                    
-                    ocr_data.append({
-                        'text': text,
-                        'confidence': confidence,
-                        'x_min': float(x_min),
-                        'x_max': float(x_max),
-                        'y_min': float(y_min),
-                        'y_max': float(y_max),
-                        'x_center': (x_min + x_max) / 2,
-                        'y_center': (y_min + y_max) / 2,
-                        'width': x_max - x_min,
-                        'height': y_max - y_min
-                    })
+    # Group the remaining pieces of each box (union-find over neighbours)
+    parent = {i: i for i in loose}
+    
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    grid = {}
+    for i in loose:
+        a = items[i]
+        for j in _neighbours(grid, a, cell):
+            b = items[j]
+            if tiles[i] == tiles[j]:
+                continue
+            width = min(a['x_max'], b['x_max']) - max(a['x_min'], b['x_min'])
+            height = min(a['y_max'], b['y_max']) - max(a['y_min'], b['y_min'])
+            if width > 0 and height >= TILE_LINE_OVERLAP * min(a['height'], b['height']):
+                parent[root(i)] = root(j)
+        for key in _grid_cells(a, cell):
+            grid.setdefault(key, []).append(i)
+    
+    groups = {}
+    for i in loose:
+        groups.setdefault(root(i), []).append(i)
+    
+    text, confidence, x_min, x_max, y_min, y_max = [], [], [], [], [], []
+    for group in groups.values():
+        group.sort(key=lambda i: items[i]['x_min'])
+        joined = items[group[0]]['text']
+        for i in group[1:]:
+            joined = _stitch_text(joined, items[i]['text'])
+        text.append(joined)
+        confidence.append(min(items[i]['confidence'] for i in group))
+        x_min.append(min(items[i]['x_min'] for i in group))
+        x_max.append(max(items[i]['x_max'] for i in group))
+        y_min.append(min(items[i]['y_min'] for i in group))
+        y_max.append(max(items[i]['y_max'] for i in group))
+    return OCRBoxes.from_bounds(text, confidence, x_min, x_max, y_min, y_max)
+
+
+def run_tiled_ocr(engine, image, progress=None, cancel=None, timings=None):
+    """
+    OCR a large image tile by tile, so the detector sees text at full
+    resolution and memory stays bounded by the tile size.
+    
+    Boxes touching an inner tile edge may be cut off; the neighbouring tile
+    sees them whole if they are smaller than TILE_OVERLAP. The whole boxes
+    are offset to image coordinates and de-duplicated, and the cut pieces
+    of larger boxes, which no tile sees whole, are joined back together.
+    """
+    height, width = image.shape[:2]
+    whole, whole_tiles, cut, cut_tiles = [], [], [], []
+    for index, tile in enumerate(tile_grid(width, height)):
+        x0, y0, x1, y1 = tile
+        # A view, not a copy
+        boxes = run_ocr(engine, image[y0:y1, x0:x1], progress=progress, cancel=cancel,
+                        timings=timings, page=(x0, y0, width, height))
+        boxes = boxes.shift(x0, y0)
+        touches = _touches_inner_edge(boxes, tile, width, height)
+        whole.append(boxes[~touches])
+        whole_tiles.append(np.full(int((~touches).sum()), index))
+        cut.append(boxes[touches])
+        cut_tiles.append(np.full(int(touches.sum()), index))
+    if not whole:
+        return OCRBoxes.empty()
+    merged = merge_tile_boxes(OCRBoxes.concat(whole), np.concatenate(whole_tiles))
+    joined = merge_cut_boxes(OCRBoxes.concat(cut), np.concatenate(cut_tiles), merged)
+    return OCRBoxes.concat([merged, joined])
+
+
+def extract_ocr_data(image, progress=None, cancel=None, timings=None):
+    """
+    Run OCR on image and extract text with coordinates, using the engine
+    chosen at startup (see ocr_engines).
+    
+    Args:
+        image: Image as numpy array (grayscale or BGR), or a path to an image file
+        progress: Optional callback called with the name of each stage
+        cancel: Optional event; work stops at the next stage boundary once it is set
+        timings: Optional dict that receives the seconds spent per stage
+    
+    Returns:
+        OCRBoxes with text, confidence, and bounding box info in pixels,
+        plus nx_*/ny_* coordinates normalized to the page size, sorted
+        top to bottom
+    """
+    engine = get_engine()
+    
+    if not isinstance(image, np.ndarray):
+        image = cv2.imread(image)
+        if image is None:
+            return OCRBoxes.empty()
+    
+    # The detector expects 3 channels
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    
+    if TILE_SIZE and max(image.shape[:2]) > TILE_SIZE:
+        boxes = run_tiled_ocr(engine, image, progress=progress, cancel=cancel, timings=timings)
+    else:
+        boxes = run_ocr(engine, image, progress=progress, cancel=cancel, timings=timings)
+    
+    page_height, page_width = image.shape[:2]
+    boxes.normalize(page_width, page_height)
     
     # Sort by y-coordinate then x-coordinate
-    ocr_data.sort(key=lambda x: (x['y_center'], x['x_center']))
-    return ocr_data
+    return boxes.sorted('y_center', 'x_center')
 
 
-def extract_header_info(ocr_data):
+def _format_date(match, century_pivot=None):
     """
-    Extract header information (Name, Sl. No, Date) from OCR data.
+    Format a _DATE_PATTERN match as day/month/year. Two-digit years are
+    read as 20xx, or as 19xx from `century_pivot` on.
+    """
+    day, month, year = match.groups()
+    if len(year) == 2:
+        year = ('19' if century_pivot is not None and int(year) >= century_pivot else '20') + year
+    return f"{day}/{month}/{year}"
+
+
+@lru_cache(maxsize=None)
+def _name_noise_pattern(name_exclude):
+    """_NAME_NOISE_PATTERN extended with a layout template's vendor words"""
+    if not name_exclude:
+        return _NAME_NOISE_PATTERN
+    keywords = NAME_EXCLUDE + tuple(name_exclude)
+    return re.compile('|'.join(re.escape(keyword) for keyword in keywords))
+
+
+def extract_header_info(ocr_data, template=None):
+    """
+    Extract header information (Name, Sl. No, Date) from OCR data in a
+    single pass over the header zone. Each box is classified once, and
+    the fallback for each field is collected in the same pass.
+    
+    Args:
+        ocr_data: OCRBoxes with normalized coordinates, sorted top to bottom
+        template: Optional LayoutTemplate of the bill, whose name_exclude
+            words are never taken for the customer name
     """
     header_info = {"name": "", "sl_no": "", "date": ""}
+    name_noise = _name_noise_pattern(template.name_exclude if template is not None else ())
+    
+    # Limit search to the top of the page
+    zone = ocr_data[ocr_data.ny_center < HEADER_ZONE_BOTTOM]
     
-    # Limit search to top 300px
-    header_zone = [item for item in ocr_data if item["y_center"] < 300]
+    best_name, best_score = '', None
+    sl_label = None  # index of the last 'Sl. No' label seen
+    sl_no = sl_no_fallback = ''
+    date = date_fallback = ''
     
-    # Extract NAME (Left side)
-    name_candidates = []
-    for item in header_zone:
-        x, y = item['x_center'], item['y_center']
-        text = item['text'].strip()
+    for i, (raw_text, x, y) in enumerate(zip(zone.text.tolist(), zone.nx_center.tolist(), zone.ny_center.tolist())):
+        text = raw_text.strip()
         text_lower = text.lower()
         
-        if x < 300 and 80 < y < 220:
-            if not re.search(r'[a-zA-Z]', text) or len(text) <= 1:
-                continue
-            
+        # NAME (left side): the longest clean text, preferring the usual spot
+        if (NAME_ZONE_TOP < y < NAME_ZONE_BOTTOM and x < NAME_ZONE_RIGHT and len(text) > 1
+                and _LETTER_PATTERN.search(text) and not name_noise.search(text_lower)):
             clean_text = text.replace('.', '').strip()
-            exclude = ['darpan', 'glass', 'ply', 'concepts', 'email',
-                      'phone', 'contact', 'www', '.com', 'sl', 'no',
-                      'date', 'bill', 'mrp', 'particulars', 'qty',
-                      'rate', 'total', '080', '297']
-            
-            is_noise = any(kw in text_lower for kw in exclude)
-            
-            if not is_noise and len(clean_text) >= 3:
+            if len(clean_text) >= 3:
                 score = len(clean_text)
-                if 40 <= x <= 150:
+                if _ref_x(40) <= x <= _ref_x(150):
                     score += 5
-                if 90 <= y <= 180:
+                if _ref_y(90) <= y <= _ref_y(180):
                     score += 3
-                
-                name_candidates.append({
-                    'text': clean_text,
-                    'score': score,
-                    'x': x,
-                    'y': y
-                })
-    
-    if name_candidates:
-        best = max(name_candidates, key=lambda c: c['score'])
-        header_info['name'] = best['text']
-    
-    # Extract SL. NO
-    for i, item in enumerate(header_zone):
-        text_lower = item['text'].lower().replace(' ', '').replace('.', '')
+                if best_score is None or score > best_score:
+                    best_name, best_score = clean_text, score
         
-        if ('sl' in text_lower or 'si' in text_lower) and 'no' in text_lower:
-            for j in range(i + 1, min(i + 6, len(header_zone))):
-                next_item = header_zone[j]
-                next_text = next_item['text'].strip()
-                
-                if re.match(r'^\d{2,6}$', next_text) and next_item['x_center'] > 700:
-                    header_info['sl_no'] = next_text
-                    break
-            if header_info['sl_no']:
-                break
-    
-    # Fallback for Sl. No
-    if not header_info['sl_no']:
-        for item in header_zone:
-            if item['x_center'] > 800 and item['y_center'] < 150:
-                text = item['text'].strip()
-                if re.match(r'^\d{2,6}$', text):
-                    header_info['sl_no'] = text
-                    break
-    
-    # Extract DATE
-    for item in header_zone:
-        x = item['x_center']
-        text = item['text'].strip()
-        text_lower = text.lower()
+        # SL. NO: a number on the right within a few boxes after the label,
+        # else any number in the top right corner
+        if not sl_no:
+            compact = text_lower.replace(' ', '').replace('.', '')
+            if ('sl' in compact or 'si' in compact) and 'no' in compact:
+                sl_label = i
+            elif _SL_NO_PATTERN.match(text):
+                if sl_label is not None and i - sl_label <= SL_NO_LOOKAHEAD and x > _ref_x(700):
+                    sl_no = text
+                elif not sl_no_fallback and x > _ref_x(800) and y < _ref_y(150):
+                    sl_no_fallback = text
         
-        if 'date' in text_lower and x > 600:
-            date_match = re.search(r'\.?(\d{1,2})[\|/\.\s]*(\d{1,2})[\|/\.\s]*(\d{2,4})', text)
-            
-            if date_match:
-                day, month, year = date_match.groups()
-                if len(year) == 2:
-                    year = '20' + year if int(year) < 50 else '19' + year
-                
-                header_info['date'] = f"{day}/{month}/{year}"
-                break
-    
-    # Date fallback
-    if not header_info['date']:
-        for item in header_zone:
-            if item['x_center'] > 700 and item['y_center'] < 200:
-                date_match = re.search(r'\.?(\d{1,2})[\|/\.\s]*(\d{1,2})[\|/\.\s]*(\d{2,4})', item['text'])
-                if date_match:
-                    day, month, year = date_match.groups()
-                    if len(year) == 2:
-                        year = '20' + year
-                    header_info['date'] = f"{day}/{month}/{year}"
-                    break
+        # DATE: from a 'Date' box on the right, else any date at the top right
+        if not date and x > _ref_x(600) and 'date' in text_lower:
+            match = _DATE_PATTERN.search(text)
+            if match:
+                date = _format_date(match, century_pivot=50)
+        if not date_fallback and x > _ref_x(700) and y < _ref_y(200):
+            match = _DATE_PATTERN.search(raw_text)
+            if match:
+                date_fallback = _format_date(match)
     
+    header_info['name'] = best_name
+    header_info['sl_no'] = sl_no or sl_no_fallback
+    header_info['date'] = date or date_fallback
     return header_info
 
 
-def find_table_start(data):
-    """Find where the table data starts"""
-    for i, item in enumerate(data):
-        text = item['text'].lower().strip()
-        if 'particulars' in text or ('qty' in text and 'rate' in text):
-            return i + 5
-    return 15
+def find_table_region(data, header_row=None):
+    """
+    Find the table body: the boxes between the bottom of the table header
+    row and the top of the footer (total or signature) line. Both edges are
+    found by binary search on the vertical centers, which are sorted.
+    
+    Args:
+        data: OCRBoxes with normalized coordinates, sorted top to bottom
+        header_row: find_header_row() of data, or None
+    
+    Returns:
+        (start, end) indices of the table body in data
+    """
+    centers = data.ny_center
+    if header_row is not None:
+        header_bottom = data.ny_max[header_row[1]].max()
+        start = int(np.searchsorted(centers, header_bottom, side='right'))
+    else:
+        start = int(np.searchsorted(centers, HEADER_ZONE_BOTTOM, side='right'))
+    
+    end = len(data)
+    texts = data.text.tolist()
+    for i in range(start, len(texts)):
+        if not _FOOTER_PATTERN.search(texts[i].lower()):
+            continue
+        # Judge the whole line: OCR often reads "Sub" and "Total" as two boxes
+        height = data.ny_max[i] - data.ny_min[i]
+        line_start = int(np.searchsorted(centers, centers[i] - height, side='left'))
+        line_end = int(np.searchsorted(centers, centers[i] + height, side='right'))
+        if 'sub' in ' '.join(texts[line_start:line_end]).lower():
+            continue
+        # Exclude the whole footer line, not just the boxes right of it
+        end = int(np.searchsorted(centers, centers[i] - height / 2, side='left'))
+        break
+    return start, max(start, end)
 
 
-def group_into_rows(data, y_threshold=25):
-    """Group OCR elements into rows based on y-coordinate proximity"""
-    if not data:
+def group_into_rows(data, y_threshold=None, height_factor=ROW_HEIGHT_FACTOR):
+    """
+    Group OCRBoxes into rows in one pass over the boxes sorted by vertical
+    center.
+    
+    Each row keeps a running baseline, a moving average of its box centers
+    weighted towards the latest, and a band of one median box height around
+    it. A box joins the current row if its center is within y_threshold of
+    the baseline, or its vertical extent overlaps the band by at least
+    ROW_OVERLAP of the smaller height. Following the baseline rather than
+    the first box keeps a slightly skewed row together; strongly skewed
+    photos need OCR_CORRECT_PERSPECTIVE.
+    
+    Args:
+        data: OCRBoxes with normalized coordinates
+        y_threshold: Fraction of the page height; by default height_factor
+            times the median box height
+    
+    Returns:
+        List of rows, each a list of indices into data sorted left to right
+    """
+    count = len(data)
+    if count == 0:
         return []
     
-    data_sorted = sorted(data, key=lambda x: x['y_center'])
-    rows = []
-    current_row = [data_sorted[0]]
-    last_y = data_sorted[0]['y_center']
+    heights = data.ny_max - data.ny_min
+    band = float(np.partition(heights, count // 2)[count // 2]) / 2
+    if y_threshold is None:
+        y_threshold = height_factor * 2 * band
     
-    for item in data_sorted[1:]:
-        if abs(item['y_center'] - last_y) <= y_threshold:
-            current_row.append(item)
-        else:
-            if current_row:
-                current_row.sort(key=lambda x: x['x_center'])
-                rows.append(current_row)
-            current_row = [item]
-            last_y = item['y_center']
+    order = np.argsort(data.ny_center, kind='stable')
+    centers = data.ny_center[order].tolist()
+    # A box overlaps the band around the baseline by ROW_OVERLAP of the
+    # smaller height exactly when its center is within this distance of it
+    half = heights[order] / 2
+    reach = np.maximum(y_threshold, band + half - 2 * ROW_OVERLAP * np.minimum(band, half)).tolist()
     
-    if current_row:
-        current_row.sort(key=lambda x: x['x_center'])
-        rows.append(current_row)
+    weight = ROW_BASELINE_WEIGHT
+    starts = [0]  # position in order of the first box of each row
+    baseline = centers[0]
+    for i, (y, distance) in enumerate(zip(centers, reach)):
+        if abs(y - baseline) <= distance:
+            baseline += (y - baseline) * weight
+        else:
+            starts.append(i)
+            baseline = y
     
-    return rows
+    # Rows are runs of order; one sort orders every row left to right
+    row_ids = np.zeros(count, dtype=np.int64)
+    row_ids[starts[1:]] = 1
+    row_ids = np.cumsum(row_ids)
+    by_row = np.argsort(row_ids + np.clip(data.nx_center[order], 0.0, 1.0) / 2, kind='stable')
+    indices = order[by_row].tolist()
+    return [indices[start:end] for start, end in zip(starts, starts[1:] + [count])]
 
 
 def split_qty_rate(text):
@@ -323,9 +920,22 @@ def split_qty_rate(text):
     return text, ''
 
 
-def assign_to_columns(row_elements):
-    """Assign elements to columns based on x-position"""
-    has_typical_particulars = any(150 <= elem['x_center'] < 500 for elem in row_elements)
+def assign_to_columns(texts, x_centers, template=None):
+    """
+    Assign elements to columns based on x-position.
+    
+    Args:
+        texts: Texts of the boxes of one table row
+        x_centers: Their horizontal centers, as fractions of the page width
+        template: Optional LayoutTemplate of the bill. Without one, the
+            COLUMN_BOUNDARIES are used along with heuristics for rows that
+            do not line up with them.
+    """
+    if template is not None:
+        return _assign_to_template_columns(texts, x_centers, template)
+    
+    mrp_end, particulars_end, qty_end, rate_end = COLUMN_BOUNDARIES
+    has_typical_particulars = any(mrp_end <= x < particulars_end for x in x_centers)
     
     columns = {
         'mrp': '',
@@ -337,17 +947,16 @@ def assign_to_columns(row_elements):
     items_500_660 = []
     items_660_850 = []
     
-    for elem in row_elements:
-        x = elem['x_center']
-        text = elem['text'].strip()
+    for text, x in zip(texts, x_centers):
+        text = text.strip()
         
-        if x < 150:
+        if x < mrp_end:
             columns['mrp'] = columns['mrp'] + ' ' + text if columns['mrp'] else text
-        elif x < 500:
+        elif x < particulars_end:
             columns['particulars'] = columns['particulars'] + ' ' + text if columns['particulars'] else text
-        elif x < 660:
+        elif x < qty_end:
             items_500_660.append(text)
-        elif x < 850:
+        elif x < rate_end:
             items_660_850.append(text)
         else:
             columns['total'] = columns['total'] + ' ' + text if columns['total'] else text
@@ -378,95 +987,233 @@ def assign_to_columns(row_elements):
     }
 
 
-def process_bill_image(image_path):
+def _assign_to_template_columns(texts, x_centers, template):
+    """Assign elements to the columns of a layout template, by x-position alone"""
+    parts = {field: [] for field in COLUMN_LABELS}
+    for text, x in zip(texts, x_centers):
+        parts[template.fields[bisect_right(template.boundaries, x)]].append(text.strip())
+    columns = {field: ' '.join(values).strip() for field, values in parts.items()}
+    
+    qty, rate = columns['qty'], columns['rate']
+    if not rate:
+        # Qty and rate read as one box, or a template without a rate column
+        qty, rate = split_qty_rate(qty)
+    
+    return {
+        'mrp': columns['mrp'],
+        'particulars': columns['particulars'],
+        'qty': qty,
+        'rate': rate,
+        'total': columns['total']
+    }
+
+
+def _failure(error):
+    """Build the response for a bill that could not be processed"""
+    return {
+        'success': False,
+        'error': error,
+        'header': {},
+        'items': []
+    }
+
+
+def process_bill_image(image_path, progress=None, cancel=None, timings=None,
+                       on_partial=None, keep_boxes=False):
     """
-    Main function to process a bill image and extract structured data.
+    Process a bill image file and extract structured data.
     
     Args:
         image_path: Path to the bill image
+        progress: Optional callback called with the name of each stage
+        cancel: Optional event; ProcessingCancelled is raised at the next
+            stage boundary once it is set
+        timings: Optional dict that receives the seconds spent per stage
+        on_partial: Optional callback called as on_partial('header', header)
+            and on_partial('item', item) as soon as each part is extracted
+        keep_boxes: Also return the OCR boxes, as OCRBoxes.to_dict(), under
+            'boxes', so the bill can be laid out again without OCR
     
     Returns:
         Dictionary with header info and extracted items
     """
-    # Preprocess and save to temp file
-    processed = preprocess_image(image_path)
-    if processed is None:
-        return {
-            'success': False,
-            'error': 'Could not read image',
-            'header': {},
-            'items': []
-        }
-    
-    # Save preprocessed image to temp file
-    temp_dir = tempfile.mkdtemp()
-    temp_path = os.path.join(temp_dir, 'preprocessed.jpg')
-    cv2.imwrite(temp_path, processed)
-    
-    try:
-        # Extract OCR data
-        ocr_data = extract_ocr_data(temp_path)
-        
-        if not ocr_data:
-            return {
-                'success': False,
-                'error': 'No text detected in image',
-                'header': {},
-                'items': []
-            }
-        
-        # Extract header information
-        header_info = extract_header_info(ocr_data)
-        
-        # Find table and process rows
-        table_start = find_table_start(ocr_data)
-        table_data = ocr_data[table_start:]
-        table_rows = group_into_rows(table_data)
+    img = cv2.imread(image_path)
+    if img is None:
+        return _failure('Could not read image')
+    return process_bill_array(img, progress=progress, cancel=cancel, timings=timings,
+                              on_partial=on_partial, keep_boxes=keep_boxes)
+
+
+def process_bill_bytes(buf, progress=None, cancel=None, timings=None,
+                       on_partial=None, keep_boxes=False):
+    """
+    Process an encoded bill image held in memory (e.g. a request body).
+    
+    Args:
+        buf: bytes-like object with the encoded image
+        progress: Optional callback called with the name of each stage
+        cancel: Optional event; ProcessingCancelled is raised at the next
+            stage boundary once it is set
+        timings: Optional dict that receives the seconds spent per stage
+        on_partial: Optional callback called as on_partial('header', header)
+            and on_partial('item', item) as soon as each part is extracted
+        keep_boxes: Also return the OCR boxes, as OCRBoxes.to_dict(), under
+            'boxes', so the bill can be laid out again without OCR
+    
+    Returns:
+        Dictionary with header info and extracted items
+    """
+    with stage('decode', progress, cancel, timings):
+        img = decode_image(buf)
+    if img is None:
+        return _failure('Could not read image')
+    return process_bill_array(img, progress=progress, cancel=cancel, timings=timings,
+                              on_partial=on_partial, keep_boxes=keep_boxes)
+
+
+def process_bill_array(img, progress=None, cancel=None, timings=None,
+                       on_partial=None, keep_boxes=False):
+    """
+    Main function to process a decoded bill image and extract structured data.
+    The image never touches the disk.
+    
+    Args:
+        img: BGR image as numpy array
+        progress: Optional callback called with the name of each stage
+        cancel: Optional event; ProcessingCancelled is raised at the next
+            stage boundary once it is set
+        timings: Optional dict that receives the seconds spent per stage
+        on_partial: Optional callback called as on_partial('header', header)
+            and on_partial('item', item) as soon as each part is extracted
+        keep_boxes: Also return the OCR boxes, as OCRBoxes.to_dict(), under
+            'boxes', so the bill can be laid out again without OCR
+    
+    Returns:
+        Dictionary with header info and extracted items
+    """
+    with stage('normalize', progress, cancel, timings):
+        img, scale = normalize_resolution(img)
+    
+    offset = (0, 0)
+    if CROP_DOCUMENT:
+        with stage('crop', progress, cancel, timings):
+            img, offset = crop_to_document(img)
+    
+    with stage('preprocess', progress, cancel, timings):
+        processed = preprocess_array(img)
+    
+    # Extract OCR data, in original image coordinates
+    ocr_data = extract_ocr_data(processed, progress=progress, cancel=cancel, timings=timings)
+    scale_boxes(ocr_data, scale, offset)
+    
+    if len(ocr_data) == 0:
+        return _failure('No text detected in image')
+    
+    result = extract_layout(ocr_data, progress=progress, cancel=cancel, timings=timings,
+                            on_partial=on_partial)
+    if keep_boxes:
+        result['boxes'] = ocr_data.to_dict()
+    return result
+
+
+def extract_layout(ocr_data, progress=None, cancel=None, timings=None, on_partial=None,
+                   column_boundaries=None, row_height_factor=ROW_HEIGHT_FACTOR, learn_template=True):
+    """
+    Build the API result from OCR boxes: header fields and table items.
+    Needs no OCR engine, so recorded boxes can be laid out again on their own.
+    
+    Args:
+        ocr_data: OCRBoxes with normalized coordinates, sorted top to bottom
+        progress, cancel, timings, on_partial: as in process_bill_array()
+        column_boundaries: Optional page-width fractions between the MRP,
+            particulars, qty, rate and total columns, used instead of the
+            bill's layout template
+        row_height_factor: Row threshold in median box heights, as
+            ROW_HEIGHT_FACTOR
+        learn_template: False to never save a layout template for this
+            bill, e.g. when laying out the same boxes again
+    
+    Returns:
+        Dictionary with header info and extracted items
+    """
+    # Recognize the bill's format, or learn it
+    with stage('template', progress, cancel, timings):
+        header_row = find_header_row(ocr_data)
+        header_text = ' '.join(ocr_data.text[ocr_data.ny_center < HEADER_ZONE_BOTTOM].tolist()).lower()
+        template = get_registry().match(ocr_data, header_row, header_text,
+                                        learn=learn_template and column_boundaries is None)
+        if column_boundaries is not None:
+            template = LayoutTemplate(
+                COLUMN_LABELS, column_boundaries,
+                name_exclude=template.name_exclude if template is not None else ()
+            )
+    
+    # Extract header information
+    with stage('header', progress, cancel, timings):
+        header = format_header(extract_header_info(ocr_data, template))
+    if on_partial is not None:
+        on_partial('header', header)
+    
+    # Find table and process rows
+    with stage('table', progress, cancel, timings):
+        table_start, table_end = find_table_region(ocr_data, header_row)
+        table_data = ocr_data[table_start:table_end]
+        with stage('group_rows', timings=timings):
+            table_rows = group_into_rows(table_data, height_factor=row_height_factor)
         
-        # Process rows into items
-        items = []
-        for row_idx, row_elements in enumerate(table_rows):
-            row_text = ' '.join([elem['text'] for elem in row_elements]).lower()
-            
-            # Skip headers and footers
-            if any(header in row_text for header in ['particulars', 'qty', 'rate', 'total']) and row_idx < 3:
-                continue
-            
-            if any(footer in row_text for footer in ['signature', 'total']) and 'sub' not in row_text:
-                if row_text.count('total') > 0 and row_text.count('sub') == 0:
-                    continue
+        items = extract_items(table_data, table_rows, timings, on_partial, template)
+    
+    return {
+        'success': True,
+        'header': header,
+        'items': items
+    }
+
+
+def format_header(header_info):
+    """Convert extract_header_info() output to the API response format"""
+    return {
+        'customerName': header_info['name'],
+        'slNo': header_info['sl_no'],
+        'date': header_info['date']
+    }
+
+
+def extract_items(table_data, table_rows, timings=None, on_partial=None, template=None):
+    """
+    Turn the rows of the table body into invoice items. Each item is passed
+    to the optional on_partial('item', item) callback as soon as it is
+    built. Columns follow the optional layout template.
+    
+    Args:
+        table_data: OCRBoxes of the table body
+        table_rows: group_into_rows() of table_data
+    """
+    texts = table_data.text.tolist()
+    x_centers = table_data.nx_center.tolist()
+    items = []
+    with stage('assign_columns', timings=timings):
+        for row in table_rows:
+            row_texts = [texts[i] for i in row]
             
-            if len(row_text.strip()) < 2:
+            if len(' '.join(row_texts).strip()) < 2:
                 continue
             
-            row_data = assign_to_columns(row_elements)
+            row_data = assign_to_columns(row_texts, [x_centers[i] for i in row], template)
             
             if row_data['particulars'] or row_data['total']:
-                items.append({
+                item = {
                     'id': str(len(items) + 1),
                     'itemName': row_data['particulars'],
                     'quantity': row_data['qty'],
                     'rate': row_data['rate'],
                     'amount': row_data['total']
-                })
-        
-        return {
-            'success': True,
-            'header': {
-                'customerName': header_info['name'],
-                'slNo': header_info['sl_no'],
-                'date': header_info['date']
-            },
-            'items': items
-        }
-    
-    finally:
-        # Cleanup temp files
-        try:
-            os.remove(temp_path)
-            os.rmdir(temp_dir)
-        except:
-            pass
+                }
+                items.append(item)
+                if on_partial is not None:
+                    on_partial('item', item)
+    
+    return items
 
 
 if __name__ == '__main__':
@@ -0,0 +1,31 @@
+"""
+Record OCR Fixtures
+Runs bill images through the pipeline with the configured OCR engine and
+saves the engine's boxes as fixtures, so OCR_ENGINE=replay and
+bench_layout.py can reuse them on a machine with no models installed.
+
+Record with tiling off (the default), so each image gives one fixture.
+"""
+
+import os
+import sys
+
+import ocr_engines
+from ocr_service import process_bill_image
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print("Usage: python record_fixtures.py <image_path> [<image_path> ...]")
+        sys.exit(1)
+
+    engine = ocr_engines.RecordingEngine(ocr_engines.ENGINES[ocr_engines.ENGINE_NAME]())
+    engine.load()
+    ocr_engines.set_engine(engine)
+
+    for image_path in sys.argv[1:]:
+        engine.source = os.path.basename(image_path)
+        result = process_bill_image(image_path)
+        status = 'ok' if result.get('success') else result.get('error')
+        print(f"{image_path}: {status}")
+    print(f"Fixtures saved in {engine.directory}")
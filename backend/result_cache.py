@@ -0,0 +1,153 @@
+"""
+Result Cache Module
+Content-addressed cache of extraction results, keyed on the image bytes and pipeline parameters.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+# Configuration
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 256))  # entries kept in memory
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")  # optional on-disk tier
+RESULT_CACHE_DISK_SIZE = int(os.environ.get("RESULT_CACHE_DISK_SIZE", 10000))  # entries kept on disk
+
+# Once the disk tier holds more than its size, the least recently used files
+# are deleted until this fraction of it is left, so the directory is only
+# scanned once per that many writes
+DISK_PRUNE_TO = 0.9
+
+
+def cache_key(data, params):
+    """
+    SHA-256 of the pipeline parameters and the encoded image bytes.
+
+    Args:
+        data: bytes-like object with the uploaded image
+        params: JSON-serializable dict of parameters that affect the result
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    digest.update(b'\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier result cache: a bounded in-memory LRU in front of an optional
+    directory of JSON files that survives restarts. The directory is bounded
+    too, to `disk_size` files, evicted least recently used first by their
+    modification time, which a read refreshes.
+    """
+
+    def __init__(self, size=RESULT_CACHE_SIZE, directory=RESULT_CACHE_DIR, disk_size=RESULT_CACHE_DISK_SIZE):
+        self.size = size
+        self.directory = directory or None
+        self.disk_size = disk_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._prune_lock = threading.Lock()
+        self._disk_count = 0  # files on disk, counted at startup and on each prune
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._disk_count = len(self._disk_files())
+
+    def get(self, key):
+        """Return the cached result for this key, or None"""
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                return result
+
+        result = self._read_disk(key)
+        if result is not None:
+            self._remember(key, result)
+        return result
+
+    def put(self, key, result):
+        self._remember(key, result)
+        self._write_disk(key, result)
+
+    def _remember(self, key, result):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            os.utime(path)  # most recently used
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def _write_disk(self, key, result):
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            existed = os.path.exists(path)
+            # Write then rename so readers never see a partial file
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+        if not existed:
+            with self._lock:
+                self._disk_count += 1
+                full = self._disk_count > self.disk_size
+            if full:
+                self._prune_disk()
+
+    def _disk_files(self):
+        """(modification time, path) of every cached file"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    files.append((os.path.getmtime(path), path))
+                except OSError:
+                    pass
+        return files
+
+    def _prune_disk(self):
+        """Delete the least recently used files down to DISK_PRUNE_TO of disk_size"""
+        if not self._prune_lock.acquire(blocking=False):
+            return  # another thread is already pruning
+        try:
+            files = sorted(self._disk_files())
+            excess = len(files) - int(self.disk_size * DISK_PRUNE_TO)
+            removed = 0
+            for _, path in files[:max(0, excess)]:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+            with self._lock:
+                self._disk_count = len(files) - removed
+        finally:
+            self._prune_lock.release()
@@ -0,0 +1,39 @@
+"""
+Stages Module
+Cancellation checks and per-stage progress and timing, shared by the extraction pipeline and the OCR engines.
+"""
+
+import time
+from contextlib import contextmanager
+
+
+class ProcessingCancelled(Exception):
+    """Raised at a stage boundary when the caller has cancelled the work"""
+
+
+def report_stage(progress, name):
+    """Notify the optional progress callback that a pipeline stage has started"""
+    if progress is not None:
+        progress(name)
+
+
+def check_cancelled(cancel):
+    """Stop at a stage boundary if the optional cancel event has been set"""
+    if cancel is not None and cancel.is_set():
+        raise ProcessingCancelled()
+
+
+@contextmanager
+def stage(name, progress=None, cancel=None, timings=None):
+    """
+    Run one pipeline stage: stop first if cancelled, report the stage,
+    and add its duration in seconds to the optional `timings` dict.
+    """
+    check_cancelled(cancel)
+    report_stage(progress, name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
@@ -0,0 +1,439 @@
+"""
+Worker Pool Module
+Pre-forked OCR worker processes, each holding its own warm OCR engine.
+"""
+
+import atexit
+import multiprocessing
+import multiprocessing.connection
+import os
+import threading
+import time
+from collections import deque
+
+
+# Configuration
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", 2))
+CANCEL_GRACE = float(os.environ.get("OCR_CANCEL_GRACE", 5))  # seconds before a cancelled worker is killed
+
+# A worker that exits before its models are loaded (e.g. no OCR engine
+# installed) is restarted after RESPAWN_DELAY seconds, doubling with each
+# failure in a row up to RESPAWN_MAX_DELAY. Workers that die after loading
+# are replaced at once.
+RESPAWN_DELAY = 1.0
+RESPAWN_MAX_DELAY = 300.0
+
+# Workers are spawned rather than forked: the API process runs threads and
+# the OCR runtime is not fork-safe.
+_mp = multiprocessing.get_context('spawn')
+
+
+def _worker_main(conn, cancel):
+    """
+    Entry point of a worker process.
+
+    Loads and warms up the OCR model once, then runs tasks received on `conn`
+    until it receives None. Every message sent back is a tuple of
+    (kind, task_id, payload).
+    """
+    from ocr_service import warm_up, ProcessingCancelled
+
+    try:
+        info = warm_up()
+    except Exception as e:
+        conn.send(('failed', None, str(e)))
+        return
+    conn.send(('ready', None, info))
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+
+        task_id, func, args = task
+        cancel.clear()
+
+        def progress(stage):
+            conn.send(('stage', task_id, stage))
+
+        def on_partial(event, data):
+            conn.send(('partial', task_id, (event, data)))
+
+        timings = {}
+        try:
+            result = func(*args, progress=progress, cancel=cancel, timings=timings, on_partial=on_partial)
+            message = ('done', task_id, result)
+        except ProcessingCancelled:
+            message = ('cancelled', task_id, None)
+        except Exception as e:
+            message = ('error', task_id, str(e))
+        conn.send(('timings', task_id, timings))
+        conn.send(message)
+
+
+class _Task:
+    """A unit of work queued on the pool"""
+
+    def __init__(self, task_id, func, args, callback, timeout):
+        self.id = task_id
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.timeout = timeout
+        self.queued_at = time.time()
+        self.deadline = None  # set when dispatched, if there is a timeout
+        self.kill_at = None  # set when cancellation is requested
+        self.timed_out = False
+
+
+class _Worker:
+    """Parent-side handle of one worker process"""
+
+    def __init__(self, worker_id, slot):
+        self.id = worker_id
+        self.slot = slot  # position in the pool, kept by replacements
+        # One pipe per worker: killing a worker can never corrupt another's channel
+        self.conn, child_conn = _mp.Pipe()
+        self.cancel = _mp.Event()
+        self.process = _mp.Process(
+            target=_worker_main,
+            args=(child_conn, self.cancel),
+            name=f'ocr-worker-{worker_id}',
+            daemon=True
+        )
+        self.ready = False
+        self.ready_info = None  # model load and warmup times once ready
+        self.error = None  # model load error, if any
+        self.task = None  # _Task while busy
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+
+
+class WorkerPool:
+    """
+    Fixed-size pool of OCR worker processes.
+
+    Tasks are dispatched one at a time to idle workers whose models are
+    loaded. A worker that dies fails only its current task and is replaced
+    with a fresh process; one that dies while loading its models is retried
+    with exponential backoff.
+
+    A task with a timeout may wait that long for a worker and then run that
+    long; it is cancelled with payload 'timeout' if either runs out, so tasks
+    never wait forever while no worker can load its models.
+
+    Cancelling a running task first asks the worker to stop at the next stage
+    boundary; if it is still busy after `cancel_grace` seconds the process is
+    killed and replaced, so abandoned work never keeps a core busy.
+
+    Task callbacks are called from the pool's collector thread as
+    callback(kind, payload) with kind one of 'start', 'stage', 'partial'
+    ((event, data) partial result), 'timings' (seconds per stage), and finally 'done', 'error' or 'cancelled'
+    ('cancelled' has payload 'timeout' when the task ran out of time).
+    """
+
+    def __init__(self, size=OCR_WORKERS, cancel_grace=CANCEL_GRACE):
+        self.size = max(1, size)
+        self.cancel_grace = cancel_grace
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._workers = {}
+        self._failures = [0] * self.size  # startup failures in a row, per slot
+        self._errors = [None] * self.size  # last model load error, per slot
+        self._respawn_at = {}  # slot -> time its next worker is started
+        self._collector = None
+        self._next_worker_id = 0
+        self._started = False
+        self._closed = False
+
+    def start(self):
+        """Spawn the worker processes. Safe to call more than once."""
+        with self._lock:
+            if self._started:
+                return
+            for slot in range(self.size):
+                self._spawn_worker(slot)
+            self._collector = threading.Thread(
+                target=self._collect, name='ocr-pool-collector', daemon=True
+            )
+            self._collector.start()
+            self._started = True
+        atexit.register(self.shutdown)
+
+    def submit(self, task_id, func, args, callback, timeout=None, max_pending=None):
+        """
+        Queue `func(*args, progress=..., cancel=..., timings=..., on_partial=...)`
+        to run in a worker process.
+        The task is cancelled if it waits for a worker, or then runs, for
+        longer than `timeout` seconds.
+
+        Returns False, without queueing the task, if no worker is free and
+        `max_pending` tasks are already waiting.
+        """
+        self.start()
+        with self._lock:
+            if max_pending is not None and len(self._pending) >= max_pending and not self._has_idle_worker():
+                return False
+            self._pending.append(_Task(task_id, func, args, callback, timeout))
+            dispatched = self._dispatch()
+        self._send(dispatched)
+        return True
+
+    def stats(self):
+        """Return (waiting, running) task counts"""
+        with self._lock:
+            running = sum(1 for worker in self._workers.values() if worker.task is not None)
+            return len(self._pending), running
+
+    def cancel(self, task_id):
+        """Cancel a queued or running task. Returns False if it is not known."""
+        with self._lock:
+            for task in self._pending:
+                if task.id == task_id:
+                    self._pending.remove(task)
+                    break
+            else:
+                for worker in self._workers.values():
+                    if worker.task is not None and worker.task.id == task_id:
+                        self._request_cancel(worker)
+                        return True
+                return False
+
+        self._notify(task.callback, 'cancelled', None)
+        return True
+
+    def readiness(self):
+        """
+        Describe which workers have finished loading their models, one entry
+        per pool slot. A slot whose worker failed to load reports the error,
+        also while its replacement is loading or waiting to be started.
+        """
+        now = time.time()
+        with self._lock:
+            by_slot = {worker.slot: worker for worker in self._workers.values()}
+            workers = []
+            for slot in range(self.size):
+                worker = by_slot.get(slot)
+                error = self._errors[slot]
+                if worker is None:
+                    status = {'slot': slot, 'id': None, 'ready': False, 'busy': False}
+                    if slot in self._respawn_at:
+                        status['restartIn'] = round(max(0.0, self._respawn_at[slot] - now), 1)
+                else:
+                    status = {
+                        'slot': slot,
+                        'id': worker.id,
+                        'ready': worker.ready,
+                        'busy': worker.task is not None,
+                        **(worker.ready_info or {})
+                    }
+                if error and not status['ready']:
+                    status['error'] = error
+                workers.append(status)
+        return {
+            'ready': any(worker['ready'] for worker in workers),
+            'readyWorkers': sum(1 for worker in workers if worker['ready']),
+            'workers': workers
+        }
+
+    def shutdown(self):
+        """Stop the workers once they finish their current task"""
+        with self._lock:
+            self._closed = True
+            for worker in self._workers.values():
+                worker.stop()
+
+    def _spawn_worker(self, slot):
+        worker = _Worker(self._next_worker_id, slot)
+        self._workers[worker.id] = worker
+        self._next_worker_id += 1
+        return worker
+
+    def _request_cancel(self, worker):
+        """Ask a worker to stop its task. Caller must hold the lock."""
+        if worker.task.kill_at is None:
+            worker.task.kill_at = time.time() + self.cancel_grace
+            worker.cancel.set()
+
+    @staticmethod
+    def _is_idle(worker):
+        return worker.ready and worker.task is None and worker.process.is_alive()
+
+    def _has_idle_worker(self):
+        """Caller must hold the lock"""
+        return any(self._is_idle(worker) for worker in self._workers.values())
+
+    def _dispatch(self):
+        """
+        Assign pending tasks to idle workers whose models are loaded. Caller
+        must hold the lock, and pass the result to _send() after releasing it.
+
+        Returns:
+            List of (worker, task) pairs to send
+        """
+        dispatched = []
+        for worker in self._workers.values():
+            if not self._pending:
+                break
+            if self._is_idle(worker):
+                task = self._pending.popleft()
+                if task.timeout is not None:
+                    task.deadline = time.time() + task.timeout
+                worker.task = task
+                dispatched.append((worker, task))
+        return dispatched
+
+    def _send(self, dispatched):
+        """
+        Send assigned tasks to their workers. Called without the lock: a
+        large upload can fill the pipe, and the worker may still be busy
+        reading the previous message.
+        """
+        for worker, task in dispatched:
+            self._notify(task.callback, 'start', None)
+            try:
+                worker.conn.send((task.id, task.func, task.args))
+            except OSError:
+                # The worker just died; the reaper fails the task
+                pass
+
+    def _collect(self):
+        """Route worker messages to task callbacks and replace dead or stuck workers"""
+        while True:
+            with self._lock:
+                conns = {worker.conn: worker.id for worker in self._workers.values()}
+
+            if conns:
+                readable = multiprocessing.connection.wait(list(conns), timeout=0.5)
+            else:
+                # Every slot is waiting to be restarted
+                readable = []
+                time.sleep(0.5)
+            for conn in readable:
+                try:
+                    kind, task_id, payload = conn.recv()
+                except (EOFError, OSError):
+                    # The worker has exited; the reaper below replaces it
+                    continue
+                self._route(kind, conns[conn], task_id, payload)
+
+            self._enforce_deadlines()
+            self._reap_dead_workers()
+
+    def _route(self, kind, worker_id, task_id, payload):
+        task, dispatched = None, []
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker is None:
+                return
+            if kind == 'ready':
+                worker.ready = True
+                worker.ready_info = payload
+                self._failures[worker.slot] = 0
+                self._errors[worker.slot] = None
+                dispatched = self._dispatch()
+            elif kind == 'failed':
+                worker.error = payload
+                self._errors[worker.slot] = payload
+            elif worker.task is not None and worker.task.id == task_id:
+                task = worker.task
+                if kind in ('done', 'error', 'cancelled'):
+                    worker.task = None
+                    dispatched = self._dispatch()
+                if kind == 'cancelled' and task.timed_out:
+                    payload = 'timeout'
+
+        if task is not None:
+            self._notify(task.callback, kind, payload)
+        self._send(dispatched)
+
+    def _enforce_deadlines(self):
+        """Cancel tasks past their timeout and kill workers that ignore cancellation"""
+        now = time.time()
+        with self._lock:
+            expired = [
+                task for task in self._pending
+                if task.timeout is not None and now - task.queued_at > task.timeout
+            ]
+            for task in expired:
+                self._pending.remove(task)
+                task.timed_out = True
+            for worker in self._workers.values():
+                task = worker.task
+                if task is None:
+                    continue
+                if task.deadline is not None and now > task.deadline and task.kill_at is None:
+                    task.timed_out = True
+                    self._request_cancel(worker)
+                if task.kill_at is not None and now > task.kill_at and worker.process.is_alive():
+                    worker.process.kill()
+
+        for task in expired:
+            self._notify(task.callback, 'cancelled', 'timeout')
+
+    def _reap_dead_workers(self):
+        now = time.time()
+        with self._lock:
+            dead = [w for w in self._workers.values() if not w.process.is_alive()]
+            finished = []
+            for worker in dead:
+                del self._workers[worker.id]
+                if not worker.ready:
+                    self._read_load_error(worker)
+                worker.conn.close()
+                task = worker.task
+                if task is not None:
+                    if task.kill_at is None:
+                        finished.append((task.callback, 'error', 'OCR worker crashed'))
+                    else:
+                        finished.append((task.callback, 'cancelled', 'timeout' if task.timed_out else None))
+                if self._closed:
+                    continue
+                if worker.ready:
+                    self._spawn_worker(worker.slot)
+                else:
+                    # Loading the models failed; it will most likely fail again
+                    self._errors[worker.slot] = worker.error or (
+                        f"OCR worker exited while loading models (exit code {worker.process.exitcode})"
+                    )
+                    self._failures[worker.slot] += 1
+                    delay = RESPAWN_DELAY * 2 ** (self._failures[worker.slot] - 1)
+                    self._respawn_at[worker.slot] = now + min(delay, RESPAWN_MAX_DELAY)
+
+            due = [slot for slot, at in self._respawn_at.items() if at <= now]
+            for slot in due:
+                del self._respawn_at[slot]
+                if not self._closed:
+                    self._spawn_worker(slot)
+            dispatched = self._dispatch() if dead or due else []
+
+        for callback, kind, payload in finished:
+            self._notify(callback, kind, payload)
+        self._send(dispatched)
+
+    @staticmethod
+    def _read_load_error(worker):
+        """Pick up a 'failed' message the collector has not read yet"""
+        try:
+            while worker.conn.poll():
+                kind, _, payload = worker.conn.recv()
+                if kind == 'failed':
+                    worker.error = payload
+        except (EOFError, OSError):
+            pass
+
+    @staticmethod
+    def _notify(callback, kind, payload):
+        try:
+            callback(kind, payload)
+        except Exception:
+            pass